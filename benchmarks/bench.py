@@ -0,0 +1,231 @@
+'''
+    fernetvault benchmark suite
+
+    Builds synthetic vaults in a temporary directory and times the main vault operations,
+    writing machine readable JSON so runs can be compared between versions:
+
+        python benchmarks/bench.py --output results.json
+        python benchmarks/bench.py --sizes 10,1000 --compare results.json --threshold 0.25
+
+    Requires `fernetvault` to be importable, e.g. after `pip3 install .`
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from fernetvault import _version
+from fernetvault.crypto.encryption import Encryption
+from fernetvault.models.cache import SecretCache
+from fernetvault.models.secret import Secret
+from fernetvault.models.vault import Vault, unlock
+from fernetvault.ui import vaults as vaultsUI
+
+PASSWORD = 'benchmark'
+default_sizes = [10, 1000, 10000, 100000]
+
+
+def timeit(fn, repeat: int = 5) -> dict:
+    '''Run `fn` `repeat` times, returns seconds per run'''
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {'median': statistics.median(runs), 'min': min(runs), 'runs': repeat}
+
+
+def synthetic_secret(i: int) -> Secret:
+    return Secret(
+        'secret-{}'.format(i),
+        url='https://host-{}.example.com'.format(i % 97),
+        category='category-{}'.format(i % 7),
+        tags=['tag-{}'.format(i % 5), 'tag-{}'.format(i % 11)],
+        notes='Synthetic notes for secret {}\n'.format(i) * 3,
+        value=os.urandom(24).hex())
+
+
+def build_vault(base: str, size: int, layout: str = 'flat') -> Vault:
+    '''A vault with `size` secrets, tokens and index are written in one go to keep setup fast'''
+    name = 'bench-{}'.format(size)
+    Vault(name, dir=os.path.join(base, name)).initialize(Encryption(PASSWORD))
+    vault = unlock(Vault(name, dir=os.path.join(base, name)), PASSWORD)
+    vault.migrate_layout(layout)
+    vault.index.loaded = True
+    with vault.group_commit():
+        for i in range(size):
+            secret = synthetic_secret(i)
+            vault.storage.write(secret.name, vault.crypto.encrypt(secret.dump()))
+            vault.index.add(secret, vault.storage.mtime(secret.name))
+    vault.index.save(vault.crypto)
+    vault.storage.close()
+    return vault
+
+
+def bench_vault(base: str, size: int, repeat: int, layout: str = 'flat') -> dict:
+    results = {}
+    vault = build_vault(base, size, layout)
+    names = vault.list()
+    sample = random.Random(size).sample(names, min(len(names), 100))
+
+    results['unlock'] = timeit(lambda: Vault(vault.name, dir=vault.dir).unlock(PASSWORD), repeat)
+
+    def store():
+        for i in range(len(sample[:20])):
+            vault.store(synthetic_secret(size + i))
+    # Per operation, first run also pays for loading the index
+    results['store'] = per_op(timeit(store, repeat), len(sample[:20]))
+
+    def read():
+        for name in sample:
+            vault.read(name)
+    results['read'] = per_op(timeit(read, repeat), len(sample))
+
+    vault.cache = SecretCache()
+    results['read_cached'] = per_op(timeit(read, repeat), len(sample))
+    vault.cache = None
+
+    batch = [synthetic_secret(size + i) for i in range(len(sample))]
+    results['store_many'] = per_op(timeit(lambda: vault.store_many(batch), repeat), len(batch))
+    results['read_many'] = per_op(timeit(lambda: list(vault.read_many(sample)), repeat), len(sample))
+
+    results['list'] = timeit(vault.list, repeat)
+    results['query'] = timeit(lambda: vault.query(category='category-3'), repeat)
+    return results
+
+
+def large_secret(i: int) -> Secret:
+    '''A secret with pages of notes, such as a recovery document or a certificate bundle'''
+    secret = synthetic_secret(i)
+    secret.notes = ''.join('Line {} of notes for secret {}: {}\n'.format(n, i, os.urandom(8).hex()) for n in range(150))
+    return secret
+
+
+# Payload encodings: legacy pretty-printed JSON, then `Secret.dump` without and with compression
+encodings = {
+    'json': lambda secret: str(secret).encode(),
+    'compact': lambda secret: secret.dump(compression=None),
+    'zlib': lambda secret: secret.dump(compression='zlib'),
+    'lzma': lambda secret: secret.dump(compression='lzma'),
+}
+
+
+def bench_payloads(repeat: int, count: int = 200) -> dict:
+    '''Token size and encrypt/decrypt throughput of each payload encoding, for small and large secrets'''
+    results = {}
+    crypto = Encryption(PASSWORD)
+    crypto.EKEY()
+    for kind, make in (('small', synthetic_secret), ('large', large_secret)):
+        secrets = [make(i) for i in range(count)]
+        for encoding, encode in encodings.items():
+            tokens = [crypto.encrypt(encode(secret)) for secret in secrets]
+            token_bytes = sum(len(token) for token in tokens) / count
+
+            encrypt = per_op(timeit(lambda: [crypto.encrypt(encode(secret)) for secret in secrets], repeat), count)
+            decrypt = per_op(timeit(lambda: [Secret.load(crypto.decrypt(token)) for token in tokens], repeat), count)
+            for op, timing in (('encrypt', encrypt), ('decrypt', decrypt)):
+                timing['token_bytes'] = token_bytes
+                timing['per_second'] = 1 / timing['median']
+                results['payload_{}/{}/{}'.format(op, encoding, kind)] = timing
+    return results
+
+
+def per_op(timing: dict, ops: int) -> dict:
+    return {**timing, 'median': timing['median'] / ops, 'min': timing['min'] / ops, 'ops': ops}
+
+
+def bench_cli(home: str, repeat: int) -> dict:
+    '''Wall time from process start to the first line `fernetvault` prints'''
+    env = dict(os.environ, HOME=home)
+    # Run against the same fernetvault this suite imported
+    package = os.path.dirname(os.path.dirname(os.path.abspath(_version.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package, env.get('PYTHONPATH')]))
+
+    def startup():
+        proc = subprocess.Popen([sys.executable, '-m', 'fernetvault'], env=env,
+                                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        proc.stdout.readline()
+        proc.kill()
+        proc.wait()
+    return timeit(startup, repeat)
+
+
+def run(sizes: list, repeat: int, layout: str = 'flat') -> dict:
+    results = {}
+    home = tempfile.mkdtemp(prefix='fernetvault-bench-')
+    base = os.path.join(home, '.vaults')
+    os.mkdir(base)
+    try:
+        for size in sizes:
+            print("Benchmarking vault with {} secrets".format(size), file=sys.stderr)
+            for op, timing in bench_vault(base, size, repeat, layout).items():
+                results['{}/{}'.format(op, size)] = timing
+        results.update(bench_payloads(repeat))
+        results['list_vaults'] = timeit(lambda: vaultsUI.list_vaults(base), repeat)
+        results['cli_startup'] = bench_cli(home, repeat)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    return {
+        'version': _version.__version__,
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'cpus': os.cpu_count(),
+        'timestamp': datetime.now().isoformat(),
+        'layout': layout,
+        'results': results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    '''Metrics whose median got slower than `threshold` (a fraction) compared to the baseline'''
+    regressions = []
+    for metric, timing in current['results'].items():
+        if metric not in baseline['results']:
+            continue
+        before = baseline['results'][metric]['median']
+        after = timing['median']
+        if before > 0 and after > before * (1 + threshold):
+            regressions.append((metric, before, after))
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark fernetvault operations")
+    parser.add_argument('--sizes', help="Comma-separated vault sizes", type=lambda v: [int(s) for s in v.split(',')], default=default_sizes)
+    parser.add_argument('--repeat', help="Runs per measurement", type=int, default=5)
+    parser.add_argument('--layout', help="Directory layout of the benchmark vaults", choices=['flat', 'sharded'], default='flat')
+    parser.add_argument('-o', '--output', help="Write results as JSON to this file (default stdout)", type=str)
+    parser.add_argument('--compare', help="Baseline JSON results to check for regressions", type=str)
+    parser.add_argument('--threshold', help="Allowed slowdown against the baseline, as a fraction", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    current = run(args.sizes, args.repeat, args.layout)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=4)
+    else:
+        print(json.dumps(current, indent=4))
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        for metric, before, after in regressions:
+            print("REGRESSION {}: {:.6f}s -> {:.6f}s (+{:.0%})".format(metric, before, after, after / before - 1), file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions above {:.0%}".format(args.threshold), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+'''
+    Import-time budget check
+
+    Listing vaults and listing a vault's secrets must stay fast and never load `cryptography`.
+    Each scenario runs in a fresh interpreter, exits with status 1 when over budget:
+
+        python benchmarks/startup.py --budget-ms 100
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from fernetvault import _version
+
+scenarios = {
+    'list_vaults': '''
+import time
+start = time.perf_counter()
+from fernetvault import fernetvault
+from fernetvault.ui import vaults
+vaults.list_vaults(base)
+''',
+    'list_secrets': '''
+import time
+start = time.perf_counter()
+from fernetvault.models.vault import Vault
+Vault('startup', dir=base).list()
+''',
+}
+
+report = '''
+import json, sys
+print(json.dumps({'ms': (time.perf_counter() - start) * 1000, 'heavy': sorted(m for m in heavy if m in sys.modules)}))
+'''
+
+# Modules that must not be imported just to list things
+heavy = ['cryptography', 'schedule', 'http.server', 'concurrent.futures.process', 'multiprocessing']
+
+
+def run(scenario: str, base: str) -> dict:
+    code = 'base = {!r}\nheavy = {!r}\n'.format(base, heavy) + scenarios[scenario] + report
+    env = dict(os.environ)
+    package = os.path.dirname(os.path.dirname(os.path.abspath(_version.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package, env.get('PYTHONPATH')]))
+    out = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(out)
+
+
+def check(budget_ms: float, repeat: int = 5) -> list:
+    '''Returns a list of failures, empty when every scenario is within budget'''
+    failures = []
+    base = tempfile.mkdtemp(prefix='fernetvault-startup-')
+    os.makedirs(os.path.join(base, 'secrets'))
+    for scenario in scenarios:
+        runs = [run(scenario, base) for _ in range(repeat)]
+        median = statistics.median(r['ms'] for r in runs)
+        print("{}: {:.1f}ms (budget {:.0f}ms)".format(scenario, median, budget_ms), file=sys.stderr)
+        if median > budget_ms:
+            failures.append("{} took {:.1f}ms".format(scenario, median))
+        if runs[0]['heavy']:
+            failures.append("{} imported {}".format(scenario, ", ".join(runs[0]['heavy'])))
+    os.rmdir(os.path.join(base, 'secrets'))
+    os.rmdir(base)
+    return failures
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Check fernetvault startup against an import-time budget")
+    parser.add_argument('--budget-ms', dest="budget_ms", help="Allowed import and listing time", type=float, default=100)
+    parser.add_argument('--repeat', help="Runs per scenario", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    failures = check(args.budget_ms, args.repeat)
+    for failure in failures:
+        print("FAIL {}".format(failure), file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+'''
+    Multi-process stress test of concurrent vault access
+
+    Writer processes keep overwriting, removing and re-storing secrets of one vault while a growing
+    number of reader processes read them back, checking every secret read against a digest stored
+    alongside its value. Prints read and write throughput per reader count, then checks the vault,
+    its index and every secret once all processes are done:
+
+        python benchmarks/stress.py --readers 1,2,4,8 --writers 2 --seconds 3
+        python benchmarks/stress.py --format packed
+
+    Exits 1 if any torn or corrupt secret was read, or the vault does not check out afterwards.
+    Requires `fernetvault` to be importable, e.g. after `pip3 install .`
+'''
+import argparse
+import hashlib
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from fernetvault.crypto.encryption import Encryption
+from fernetvault.models.secret import Secret
+from fernetvault.models.vault import Vault, SecretNotFoundError, unlock
+
+PASSWORD = 'stress'
+NAME = 'stress'
+
+
+def make_secret(name: str, version: int) -> Secret:
+    value = os.urandom(random.randint(16, 2048)).hex()
+    return Secret(name, category='stress', tags=['v{}'.format(version % 4)], notes='version {}'.format(version),
+                  value=value, check=hashlib.sha256((name + value).encode()).hexdigest())
+
+
+def sound(secret: Secret) -> bool:
+    return secret.check == hashlib.sha256((secret.name + secret.value).encode()).hexdigest()
+
+
+def open_vault(path: str, key: bytes) -> Vault:
+    vault = Vault(NAME, dir=path)
+    if not vault.unlock_key(key):
+        raise RuntimeError("Could not unlock {}".format(path))
+    return vault
+
+
+def writer(path: str, key: bytes, names: list, deadline: float, results):
+    vault = open_vault(path, key)
+    rng = random.Random(os.getpid())
+    counts = {'writes': 0, 'removes': 0, 'errors': 0}
+    version = 0
+    while time.time() < deadline:
+        name = rng.choice(names)
+        version += 1
+        try:
+            if rng.random() < 0.1:
+                vault.remove(name)
+                counts['removes'] += 1
+            vault.store(make_secret(name, version))
+            counts['writes'] += 1
+        except Exception as err:
+            print("writer: {}: {!r}".format(name, err), file=sys.stderr)
+            counts['errors'] += 1
+    vault.lock()
+    results.put(counts)
+
+
+def reader(path: str, key: bytes, names: list, deadline: float, results):
+    vault = open_vault(path, key)
+    rng = random.Random(os.getpid())
+    counts = {'reads': 0, 'missing': 0, 'corrupt': 0}
+    while time.time() < deadline:
+        name = rng.choice(names)
+        try:
+            secret = vault.read(name)
+        except SecretNotFoundError:
+            # Removed by a writer, about to be stored again
+            counts['missing'] += 1
+            continue
+        except Exception as err:
+            print("reader: {}: {!r}".format(name, err), file=sys.stderr)
+            counts['corrupt'] += 1
+            continue
+        if secret is None:
+            counts['missing'] += 1
+        elif secret.name != name or not sound(secret):
+            counts['corrupt'] += 1
+        else:
+            counts['reads'] += 1
+    vault.lock()
+    results.put(counts)
+
+
+def run(path: str, key: bytes, names: list, readers: int, writers: int, seconds: float) -> dict:
+    context = multiprocessing.get_context()
+    results = context.Queue()
+    deadline = time.time() + seconds
+    processes = [context.Process(target=writer, args=(path, key, names, deadline, results)) for _ in range(writers)]
+    processes += [context.Process(target=reader, args=(path, key, names, deadline, results)) for _ in range(readers)]
+    for process in processes:
+        process.start()
+    totals = {}
+    for _ in processes:
+        for k, v in results.get().items():
+            totals[k] = totals.get(k, 0) + v
+    for process in processes:
+        process.join()
+    totals['reads_per_second'] = totals.get('reads', 0) / seconds
+    totals['writes_per_second'] = totals.get('writes', 0) / seconds
+    return totals
+
+
+def check(path: str, key: bytes, names: list) -> list:
+    '''Problems left in the vault once every process is done'''
+    vault = open_vault(path, key)
+    problems = []
+    report = vault.verify(workers=1)
+    problems += ["{}: {}".format(name, problem) for name, problem in report['problems'].items()]
+    problems += ["orphan file: {}".format(orphan) for orphan in report['orphans']]
+    stored = set(vault.list())
+    for name in sorted(stored):
+        if not sound(vault.read(name)):
+            problems.append("{}: digest mismatch".format(name))
+    # The index must account for every secret, without any stale entry
+    vault.index.load(vault.crypto)
+    if vault.index.stale(vault.storage.mtimes()) or set(vault.index.entries) - stored:
+        problems.append("index out of date")
+    if set(vault.query(category='stress')) != stored:
+        problems.append("index query mismatch")
+    return problems
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Stress concurrent readers and writers of one vault")
+    parser.add_argument('--readers', help="Comma-separated reader process counts", type=lambda v: [int(s) for s in v.split(',')], default=[1, 2, 4, 8])
+    parser.add_argument('--writers', help="Writer processes", type=int, default=2)
+    parser.add_argument('--secrets', help="Secrets in the vault", type=int, default=200)
+    parser.add_argument('--seconds', help="Duration of each round", type=float, default=3)
+    parser.add_argument('--format', help="Storage format of the vault", choices=['directory', 'packed'], default='directory')
+    args = parser.parse_args(argv)
+
+    base = tempfile.mkdtemp(prefix='fernetvault-stress-')
+    try:
+        path = os.path.join(base, NAME)
+        Vault(NAME, dir=path).initialize(Encryption(PASSWORD))
+        vault = unlock(Vault(NAME, dir=path), PASSWORD)
+        vault.migrate_format(args.format)
+        names = ['secret-{}'.format(i) for i in range(args.secrets)]
+        vault.store_many(make_secret(name, 0) for name in names)
+        key = vault.crypto.key
+        vault.lock()
+
+        print("{:>8} {:>8} {:>12} {:>12} {:>8} {:>8}".format("readers", "writers", "reads/s", "writes/s", "missing", "corrupt"))
+        corrupt = 0
+        for readers in args.readers:
+            totals = run(path, key, names, readers, args.writers, args.seconds)
+            corrupt += totals.get('corrupt', 0) + totals.get('errors', 0)
+            print("{:>8} {:>8} {:>12.0f} {:>12.0f} {:>8} {:>8}".format(
+                readers, args.writers, totals['reads_per_second'], totals['writes_per_second'],
+                totals.get('missing', 0), totals.get('corrupt', 0) + totals.get('errors', 0)))
+
+        problems = check(path, key, names)
+        for problem in problems:
+            print("! {}".format(problem))
+        print("{} cores, {} torn or corrupt reads, {} problems after the run".format(os.cpu_count(), corrupt, len(problems)))
+        return 1 if corrupt or problems else 0
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -38,8 +38,7 @@ setup(
     install_requires=[
         'cffi==1.16.0',
         'cryptography==41.0.7',
-        'pycparser==2.21',
-        'schedule==1.2.1'
+        'pycparser==2.21'
     ],  # external dependencies
     entry_points={"console_scripts": ["fernetvault = fernetvault.fernetvault:main"]},
     classifiers=[  # see https://pypi.org/pypi?%3Aaction=list_classifiers
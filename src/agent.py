@@ -0,0 +1,205 @@
+'''
+    Key agent, in the spirit of `ssh-agent`
+
+    Holds derived vault keys in memory behind a Unix socket that only the owning user can reach,
+    so repeated `fernetvault` invocations can skip the key derivation function.
+    Keys are forgotten after the same idle time that locks an unlocked `Vault`.
+'''
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+from datetime import datetime
+
+from .models.constants import default_config_dir
+from .models.vault import Vault
+
+default_socket = os.path.join(default_config_dir, "agent.sock")
+
+
+def socket_path() -> str:
+    return os.environ.get('FERNETVAULT_AGENT_SOCK', default_socket)
+
+
+def vault_id(vault: Vault) -> str:
+    '''Keys are held per vault config file'''
+    return os.path.realpath(vault.cfg)
+
+
+class Keyring:
+    def __init__(self):
+        self.keys = {}
+
+    def add(self, vault: str, key: str):
+        self.keys[vault] = (key, datetime.now())
+
+    def get(self, vault: str):
+        self.expire()
+        if vault not in self.keys:
+            return None
+        key, _ = self.keys[vault]
+        # Using a key keeps it alive, as using a vault does
+        self.keys[vault] = (key, datetime.now())
+        return key
+
+    def remove(self, vault: str):
+        self.keys.pop(vault, None)
+
+    def clear(self):
+        self.keys.clear()
+
+    def expire(self):
+        deadline = datetime.now() - Vault.timeout
+        for vault in [v for v, (_, used) in self.keys.items() if used < deadline]:
+            self.remove(vault)
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if not self.server.trusted(self.request):
+            return
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.dispatch(request)
+        except Exception as err:
+            response = {'error': str(err)}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+        self.wfile.flush()
+        if self.server.stopping:
+            # Handlers run on their own threads, so this cannot deadlock `serve_forever`
+            self.server.shutdown()
+
+
+class Agent(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.keyring = Keyring()
+        self.stopping = False
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        os.chmod(os.path.dirname(path), 0o700)
+        if os.path.exists(path):
+            os.remove(path)
+        # Never let the socket exist with looser permissions, not even briefly
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, AgentHandler)
+        finally:
+            os.umask(umask)
+
+    def trusted(self, conn: socket.socket) -> bool:
+        '''Only serve clients running as the same user as the agent'''
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+        return uid == os.getuid()
+
+    def dispatch(self, request: dict) -> dict:
+        op = request.get('op')
+        if op == 'get':
+            return {'key': self.keyring.get(request['vault'])}
+        if op == 'add':
+            self.keyring.add(request['vault'], request['key'])
+            return {'ok': True}
+        if op == 'remove':
+            self.keyring.remove(request['vault'])
+            return {'ok': True}
+        if op == 'clear':
+            self.keyring.clear()
+            return {'ok': True}
+        if op == 'stop':
+            self.keyring.clear()
+            self.stopping = True
+            return {'ok': True}
+        return {'error': 'Unknown operation {}'.format(op)}
+
+    def service_actions(self):
+        '''Wipe idle keys even when nobody is asking for them'''
+        self.keyring.expire()
+
+    def server_close(self):
+        super().server_close()
+        self.keyring.clear()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Client
+def request(payload: dict, path: str = None):
+    '''Send one request to the agent, returns None when no agent is reachable'''
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(2)
+            conn.connect(path)
+            conn.sendall(json.dumps(payload).encode() + b'\n')
+            with conn.makefile('rb') as reply:
+                return json.loads(reply.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def get_key(vault: Vault):
+    response = request({'op': 'get', 'vault': vault_id(vault)})
+    if response and response.get('key'):
+        return response['key'].encode()
+    return None
+
+
+def add_key(vault: Vault, key: bytes) -> bool:
+    response = request({'op': 'add', 'vault': vault_id(vault), 'key': key.decode()})
+    return bool(response and response.get('ok'))
+
+
+def remove_key(vault: Vault) -> bool:
+    response = request({'op': 'remove', 'vault': vault_id(vault)})
+    return bool(response and response.get('ok'))
+
+
+# `fernetvault agent`
+def daemonize():
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(prog='fernetvault agent', description="Hold unlocked vault keys in memory")
+    parser.add_argument('-f', '--foreground', help="Do not detach from the terminal", action='store_true')
+    parser.add_argument('--stop', help="Stop a running agent", action='store_true')
+    parser.add_argument('--clear', help="Forget all keys held by a running agent", action='store_true')
+    args = parser.parse_args(argv)
+
+    path = socket_path()
+    if args.stop or args.clear:
+        response = request({'op': 'stop' if args.stop else 'clear'}, path)
+        if not response:
+            exit("No agent running @ {}".format(path))
+        exit(0)
+
+    if request({'op': 'get', 'vault': ''}, path) is not None:
+        exit("An agent is already running @ {}".format(path))
+
+    agent = Agent(path)
+    print("FERNETVAULT_AGENT_SOCK={}; export FERNETVAULT_AGENT_SOCK;".format(path))
+    sys.stdout.flush()
+    if not args.foreground:
+        daemonize()
+    try:
+        agent.serve_forever(poll_interval=1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.server_close()
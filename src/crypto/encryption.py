@@ -1,37 +1,81 @@
 import base64
+import json
 import os
+import struct
 from typing import Union
 
+from .. import profiling
+from ..utils import atomic_write
+
 try:
-    from cryptography.fernet import Fernet
-    from cryptography.hazmat.primitives import hashes
-    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.fernet import Fernet, MultiFernet
+    from .kdf import DEFAULT as DEFAULT_KDF, derive
 except ImportError or ModuleNotFoundError:
     print('Error loading Fernet lib. Maybe missing cryptography dependency? `python3 -m pip install cryptography`')
     exit(1)
-    
+
+# Vault header: MAGIC, version byte, 2 byte length and JSON parameters, 16 salt bytes, EKEY
+# Parameters name the KDF and, while a key rotation is under way, list the retired data keys (`keys`),
+# wrapped like EKEY. Version 1 headers have no parameters and use the default KDF.
+# Legacy headers (version 0) are just the salt and EKEY, and their secrets are encrypted with the derived key
+MAGIC = b'FVLT'
+VERSION = 2
+
+
+def read_header(path: str) -> tuple:
+    '''Returns (version, params, salt, ekey) of a vault header'''
+    with profiling.phase('io.header'), open(path, 'rb') as f:
+        data = f.read()
+    params = {'kdf': DEFAULT_KDF}
+    if data.startswith(MAGIC):
+        version = data[len(MAGIC)]
+        data = data[len(MAGIC) + 1:]
+        if version >= 2:
+            size, = struct.unpack('>H', data[:2])
+            params = json.loads(data[2:2 + size])
+            data = data[2 + size:]
+    else:
+        version = 0
+    return version, params, data[:16], data[16:]
+
             
 class Encryption:
     key: bytes
     salt: Union[None, bytes]
+    rkey: Union[None, bytes]
+    # Retired data keys, still decrypting secrets a key rotation has not reached yet
+    ring: list
+    kdf: dict
+    # Secrets of legacy vaults are still encrypted with the derived key
+    legacy: bool = False
         
-    def __init__(self, key: str, salt=None):
+    def __init__(self, key: str, salt=None, rkey=None, kdf=None):
         self.key = key.encode()
         self.salt = salt
+        self.rkey = rkey
+        self.ring = []
+        self.kdf = kdf or DEFAULT_KDF
                                 
         self.digest()
+
+    @classmethod
+    def from_key(cls, key: bytes, salt: bytes, kdf=None):
+        '''Rebuild from an already derived key, skipping the key derivation function'''
+        crypto = cls.__new__(cls)
+        crypto.key = key
+        crypto.salt = salt
+        crypto.rkey = None
+        crypto.ring = []
+        crypto.kdf = kdf or DEFAULT_KDF
+        return crypto
                 
     def digest(self):
         '''To use Fernet with passkeys the password must be run through a key derivation function'''
         if self.salt is None:
             self.salt = bytes(os.urandom(16))
             
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=self.salt,
-            iterations=100000)
-        self.key = base64.urlsafe_b64encode(kdf.derive(self.key))
+        with profiling.phase('crypto.kdf'):
+            self.key = base64.urlsafe_b64encode(derive(self.key, self.salt, self.kdf))
 
     def RKEY(self):
         ''''A random key'''
@@ -39,20 +83,76 @@ class Encryption:
 
     def EKEY(self):
         '''An encrypted key that will be stored and associated with the vault'''
+        if self.rkey is None:
+            self.rkey = self.RKEY()
         f = Fernet(self.key)
-        return f.encrypt(self.RKEY())
+        return f.encrypt(self.rkey)
 
-    def decrypt(self, ekey):
-        '''Given an encrypted key, attempt to obtain RKEY'''
-        f = Fernet(self.key)
-        return f.decrypt(ekey)  # RKEY
+    def unwrap(self, ekey, ring: list = ()):
+        '''Given an encrypted key, and the encrypted retired keys of the header, attempt to obtain RKEY'''
+        with profiling.phase('crypto.unwrap'):
+            f = Fernet(self.key)
+            self.rkey = f.decrypt(ekey)
+            self.ring = [f.decrypt(k) for k in ring]
+        return self.rkey
+
+    def rotate(self):
+        '''Start a key rotation: a new RKEY encrypts from now on, the current one is retired to the ring'''
+        self.ring.insert(0, self.rkey)
+        self.rkey = self.RKEY()
+
+    def retire(self):
+        '''Forget retired keys, once nothing is encrypted with them anymore'''
+        self.ring = []
+
+    def wipe(self):
+        '''Drop every key, the vault has to be unlocked again to use them'''
+        self.key = self.rkey = None
+        self.ring = []
+
+    def fernet(self):
+        '''Secrets are encrypted with RKEY, except for legacy vaults, and decrypted with any key of the ring'''
+        if self.legacy:
+            # A migration may have been interrupted halfway through
+            return MultiFernet([Fernet(self.key), Fernet(self.rkey)])
+        if self.ring:
+            return MultiFernet([Fernet(k) for k in self.keys()])
+        return Fernet(self.rkey)
+
+    def keys(self) -> list:
+        '''Keys secrets may be encrypted with, the one new secrets are encrypted with first'''
+        if self.legacy:
+            return [self.key, self.rkey]
+        return [self.rkey] + self.ring
+
+    def rotation_keys(self) -> list:
+        '''
+            Keys to re-encrypt tokens with RKEY, those of legacy vaults or of retired keys,
+            tokens already using RKEY are only refreshed
+        '''
+        if self.legacy:
+            return [self.rkey, self.key]
+        return self.keys()
+
+    def rotator(self) -> MultiFernet:
+        return MultiFernet([Fernet(k) for k in self.rotation_keys()])
+
+    def decrypt(self, token):
+        with profiling.phase('crypto.decrypt'):
+            return self.fernet().decrypt(token)
 
     def encrypt(self, something):
-        f = Fernet(self.key)
-        return f.encrypt(something.encode())
+        if isinstance(something, str):
+            something = something.encode()
+        with profiling.phase('crypto.encrypt'):
+            return self.fernet().encrypt(something)
         
     def write(self, to: str):
-        with open(to, 'wb') as f:
-            f.write(self.salt)
-            f.write(self.EKEY())
+        '''Atomically replace the vault header at `to`, a crash leaves either the old or the new key wrapping'''
+        params = {'kdf': self.kdf}
+        if self.ring:
+            f = Fernet(self.key)
+            params['keys'] = [f.encrypt(k).decode() for k in self.ring]
+        params = json.dumps(params, separators=(',', ':')).encode()
+        atomic_write(to, MAGIC + bytes([VERSION]) + struct.pack('>H', len(params)) + params + self.salt + self.EKEY())
     
@@ -0,0 +1,92 @@
+'''
+    Key derivation functions and their parameters
+
+    Parameters are plain dicts so they can be recorded in vault headers, e.g.
+    `{"algorithm": "pbkdf2-sha256", "iterations": 100000}` or `{"algorithm": "scrypt", "n": 16384, "r": 8, "p": 1}`
+'''
+import json
+import os
+import time
+
+from ..utils import atomic_write
+
+PBKDF2 = 'pbkdf2-sha256'
+SCRYPT = 'scrypt'
+algorithms = (PBKDF2, SCRYPT)
+
+# Parameters of vaults without a recorded KDF
+DEFAULT = {'algorithm': PBKDF2, 'iterations': 100000}
+
+# Calibration never goes below the historical default strength
+min_iterations = 100000
+min_scrypt_n = 2 ** 14
+max_scrypt_n = 2 ** 20
+
+
+def derive(password: bytes, salt: bytes, params: dict = None, length: int = 32) -> bytes:
+    # Imported here so reading parameters and defaults never loads `cryptography`
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+    params = params or DEFAULT
+    algorithm = params.get('algorithm')
+    if algorithm == PBKDF2:
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=length,
+            salt=salt,
+            iterations=params['iterations'])
+    elif algorithm == SCRYPT:
+        kdf = Scrypt(salt=salt, length=length, n=params['n'], r=params['r'], p=params['p'])
+    else:
+        raise ValueError("Unsupported key derivation function {}".format(algorithm))
+    return kdf.derive(password)
+
+
+def timed(params: dict) -> float:
+    '''Seconds taken by one derivation with `params`'''
+    start = time.perf_counter()
+    derive(b'calibration', os.urandom(16), params)
+    return time.perf_counter() - start
+
+
+def calibrate(target_ms: float, algorithm: str = PBKDF2) -> dict:
+    '''Pick parameters for `algorithm` whose derivation takes about `target_ms` on this machine'''
+    target = target_ms / 1000
+    if algorithm == PBKDF2:
+        probe = {'algorithm': PBKDF2, 'iterations': min_iterations}
+        # Best of a few runs, to keep scheduler noise out of the estimate
+        elapsed = min(timed(probe) for _ in range(3))
+        iterations = int(min_iterations * target / elapsed)
+        # Round to a readable figure
+        iterations = max(min_iterations, iterations - iterations % 10000)
+        return {'algorithm': PBKDF2, 'iterations': iterations}
+
+    if algorithm == SCRYPT:
+        # Cost grows linearly with n, which must be a power of two
+        params = {'algorithm': SCRYPT, 'n': min_scrypt_n, 'r': 8, 'p': 1}
+        elapsed = min(timed(params) for _ in range(3))
+        while params['n'] < max_scrypt_n and elapsed * 2 <= target * 1.5:
+            params['n'] *= 2
+            elapsed *= 2
+        return params
+
+    raise ValueError("Unsupported key derivation function {}".format(algorithm))
+
+
+def load_defaults(path: str) -> dict:
+    '''Parameters for new vaults, as saved by calibration'''
+    try:
+        with open(path, 'r') as f:
+            params = json.load(f)
+        if params.get('algorithm') in algorithms:
+            return params
+    except (OSError, ValueError):
+        pass
+    return dict(DEFAULT)
+
+
+def save_defaults(path: str, params: dict):
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    atomic_write(path, json.dumps(params).encode())
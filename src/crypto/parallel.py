@@ -0,0 +1,124 @@
+'''
+    Fernet work spread across a pool of worker processes
+
+    Keys are handed to each worker once, through the pool initializer, instead of with every task
+'''
+import base64
+import binascii
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+
+# Below this many tokens a pool costs more than it saves
+min_parallel = 256
+batch_size = 1024
+
+# Problems found by `verify`
+CORRUPT = 'corrupt'
+TRUNCATED = 'truncated'
+FOREIGN_KEY = 'foreign key or damaged'
+UNPARSEABLE = 'unparseable'
+MISNAMED = 'misnamed'
+
+# Fernet token: version byte, timestamp, IV, ciphertext in 16 byte blocks, HMAC
+_overhead = 1 + 8 + 16 + 32
+
+_fernet = None
+_parse = None
+
+
+def _init(keys: list, parse=None):
+    global _fernet, _parse
+    _fernet = MultiFernet([Fernet(k) for k in keys])
+    _parse = parse
+
+
+def _rotate(token: bytes) -> bytes:
+    return _fernet.rotate(token)
+
+
+def check(fernet, parse, name: str, token: bytes):
+    '''The problem with the token of secret `name`, None when it decrypts and parses back to `name`'''
+    token = bytes(token)
+    if len(token) % 4:
+        return TRUNCATED
+    try:
+        data = base64.urlsafe_b64decode(token)
+    except (binascii.Error, ValueError):
+        return CORRUPT
+    if data[:1] != b'\x80':
+        return CORRUPT
+    if len(data) < _overhead + 16 or (len(data) - _overhead) % 16:
+        return TRUNCATED
+    try:
+        plaintext = fernet.decrypt(token)
+    except InvalidToken:
+        # Authentication failed: encrypted with another key, or altered
+        return FOREIGN_KEY
+    if parse is not None:
+        try:
+            secret = parse(plaintext)
+            secret.to_dict()
+        except Exception:
+            return UNPARSEABLE
+        if secret.name != name:
+            return MISNAMED
+    return None
+
+
+def _check(item: tuple) -> tuple:
+    name, token = item
+    return name, check(_fernet, _parse, name, token)
+
+
+def batches(iterable, size: int = batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def rotate(keys: list, tokens, workers: int = None):
+    '''
+        Re-encrypt `tokens` with the first of `keys`, decrypting with any of them
+
+        Yields rotated tokens in order. Tokens are consumed one batch at a time,
+        so memory stays bounded however many there are
+    '''
+    workers = workers or os.cpu_count() or 1
+    batched = batches(tokens)
+    first = next(batched, [])
+    if workers < 2 or len(first) < min_parallel:
+        fernet = MultiFernet([Fernet(k) for k in keys])
+        for batch in itertools.chain([first], batched):
+            yield from map(fernet.rotate, batch)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(keys,)) as pool:
+        for batch in itertools.chain([first], batched):
+            yield from pool.map(_rotate, batch, chunksize=max(1, len(batch) // (workers * 4)))
+
+
+def verify(keys: list, items, parse=None, workers: int = None):
+    '''
+        Check (name, token) `items`, decrypting with any of `keys` and parsing plaintexts with `parse`
+
+        Yields (name, problem) in order, problem is None for sound tokens
+    '''
+    workers = workers or os.cpu_count() or 1
+    batched = batches(items)
+    first = next(batched, [])
+    if workers < 2 or len(first) < min_parallel:
+        fernet = MultiFernet([Fernet(k) for k in keys])
+        for batch in itertools.chain([first], batched):
+            for name, token in batch:
+                yield name, check(fernet, parse, name, token)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(keys, parse)) as pool:
+        for batch in itertools.chain([first], batched):
+            yield from pool.map(_check, batch, chunksize=max(1, len(batch) // (workers * 4)))
@@ -0,0 +1,127 @@
+'''
+    Chunked, authenticated encryption of file streams
+
+    Layout: header, then segments of `segment_size` plaintext bytes, each sealed with AES-256-GCM.
+    The header holds a random per-file key, wrapped (Fernet encrypted) with the vault's data key,
+    and a random nonce prefix. Each segment nonce is the prefix, a 32 bit segment counter and a
+    final-segment flag, so reordered, dropped or truncated segments fail to authenticate.
+
+    Only a couple of segments are ever held in memory, whatever the size of the stream.
+'''
+import os
+import shutil
+import struct
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from ..utils import atomic_open
+
+MAGIC = b'FVA1'
+segment_size = 64 * 1024
+tag_size = 16
+prefix_size = 7
+
+# MAGIC, segment size, wrapped key length
+_fixed = struct.Struct('>4sIH')
+
+
+def _nonce(prefix: bytes, counter: int, last: bool) -> bytes:
+    return prefix + struct.pack('>I?', counter, last)
+
+
+def _read(src, size: int) -> bytes:
+    '''Read exactly `size` bytes unless the stream ends first'''
+    data = src.read(size)
+    while data and len(data) < size:
+        more = src.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def _aad(segment: int, prefix: bytes) -> bytes:
+    '''Segments are bound to the stream parameters, not to the wrapped key, so keys can be re-wrapped'''
+    return MAGIC + struct.pack('>I', segment) + prefix
+
+
+def encrypt(crypto, src, dst, segment: int = segment_size) -> int:
+    '''Encrypt binary stream `src` into `dst`, returns the number of plaintext bytes'''
+    key = AESGCM.generate_key(bit_length=256)
+    prefix = os.urandom(prefix_size)
+    wrapped = crypto.encrypt(key)
+    dst.write(_fixed.pack(MAGIC, segment, len(wrapped)) + wrapped + prefix)
+
+    aead = AESGCM(key)
+    aad = _aad(segment, prefix)
+    size = 0
+    counter = 0
+    chunk = _read(src, segment)
+    while True:
+        following = _read(src, segment) if len(chunk) == segment else b''
+        last = not following
+        dst.write(aead.encrypt(_nonce(prefix, counter, last), chunk, aad))
+        size += len(chunk)
+        if last:
+            return size
+        chunk = following
+        counter += 1
+
+
+def _header(src) -> tuple:
+    fixed = _read(src, _fixed.size)
+    if len(fixed) < _fixed.size:
+        raise InvalidToken
+    magic, segment, wrapped_size = _fixed.unpack(fixed)
+    if magic != MAGIC:
+        raise InvalidToken
+    wrapped = _read(src, wrapped_size)
+    prefix = _read(src, prefix_size)
+    if len(wrapped) < wrapped_size or len(prefix) < prefix_size:
+        raise InvalidToken
+    return segment, wrapped, prefix
+
+
+def decrypt(crypto, src, dst) -> int:
+    '''
+        Decrypt binary stream `src` into `dst`, returns the number of plaintext bytes
+
+        Raises `InvalidToken` on tampering or truncation, by then earlier segments may already be in `dst`
+    '''
+    segment, wrapped, prefix = _header(src)
+    aead = AESGCM(crypto.decrypt(wrapped))
+    aad = _aad(segment, prefix)
+    size = 0
+    counter = 0
+    sealed = _read(src, segment + tag_size)
+    while True:
+        following = _read(src, segment + tag_size) if len(sealed) == segment + tag_size else b''
+        last = not following
+        try:
+            chunk = aead.decrypt(_nonce(prefix, counter, last), sealed, aad)
+        except InvalidTag:
+            raise InvalidToken
+        dst.write(chunk)
+        size += len(chunk)
+        if last:
+            return size
+        sealed = following
+        counter += 1
+
+
+def rewrap(path: str, rotate, group=None):
+    '''
+        Re-encrypt the per-file key of the stream at `path` with `rotate`, segments are copied as they are
+
+        The file is replaced by rename, never rewritten in place, so incremental backups see it changed
+    '''
+    with open(path, 'rb') as src:
+        segment, wrapped, prefix = _header(src)
+        rewrapped = rotate(wrapped)
+        if len(rewrapped) != len(wrapped):
+            raise ValueError("Wrapped key size changed")
+        with atomic_open(path, group) as dst:
+            dst.write(_fixed.pack(MAGIC, segment, len(rewrapped)) + rewrapped + prefix)
+            shutil.copyfileobj(src, dst, segment + tag_size)
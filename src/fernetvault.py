@@ -1,23 +1,26 @@
 import argparse # Try to create a decent cli
+import atexit
 import getpass  # Handle input password without echoing
+import json
 import os
-import schedule
-from datetime import datetime, timedelta
+import sys
+import time
+from datetime import datetime
 
-from . import utils
-from .models.constants import default_vault_dir, default_dir
+from . import profiling, utils
+from .models.constants import default_vault_dir, default_dir, default_kdf_file
+from .models.catalog import Catalog
 from .models.vault import Vault, LockedError, SecretNotFoundError, unlock
 from .models.secret import Secret
-from .crypto import encryption
+from .crypto import kdf
 from .ui import secrets as secretsUI
 from .ui import vaults as vaultsUI
 
+# Loaded on first use, listing vaults needs none of them
+agent = utils.lazy_import('.agent', __package__)
+encryption = utils.lazy_import('.crypto.encryption', __package__)
+batchUI = utils.lazy_import('.ui.batch', __package__)
 
-def schedule_lock(vault: Vault):
-    ''''Schedule  vault lock check, which also locks the vault in case vault conditions are not met'''
-    span = datetime.now() + timedelta(minutes=10)
-    schedule.every(1).second.until(span).do(vault.lock)
-    schedule.run_all()
 
 class Session:
     vault: Vault
@@ -35,6 +38,27 @@ def isvault(name):
 def prompt_password(prompt='Vault password: ') -> str:
     return getpass.getpass(prompt=prompt)
 
+def print_progress(done: int, total: int, doing: str = "Migrating"):
+    end = "\n" if done == total else ""
+    print("\r{} secrets: {}/{}".format(doing, done, total), end=end, flush=True)
+
+def export_attachment(vault: Vault, name: str, to: str):
+    if to == 'stdout':
+        sys.stdout.flush()
+        vault.export_attachment(name, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+        return
+    # Only fully decrypted and authenticated attachments replace the destination
+    partial = to + '.part'
+    try:
+        with open(partial, 'wb') as f:
+            vault.export_attachment(name, f)
+        os.replace(partial, to)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    exit("Secret exported to {}".format(to))
+
 def cli(args: argparse.Namespace):
         
     session = Session()
@@ -42,7 +66,32 @@ def cli(args: argparse.Namespace):
     if not os.path.isdir(default_vault_dir):
         '''Ensure .vaults dir exists'''
         os.mkdir(default_vault_dir)
+
+    if args.calibrate_kdf:
+        '''Benchmark this machine for KDF parameters that unlock in about `--target-ms`'''
+        params = kdf.calibrate(args.target_ms, args.kdf)
+        print("KDF parameters for ~{}ms: {}".format(args.target_ms, params))
+        if not args.vault:
+            kdf.save_defaults(default_kdf_file, params)
+            exit("New vaults will use these parameters")
         
+    if args.vaults or args.stats or args.rescan:
+        '''List vaults, with stats from the vault catalog, which `--rescan` rebuilds from the vault directories'''
+        catalog = Catalog()
+        if args.rescan:
+            vaults = catalog.rescan()
+            if not (args.vaults or args.stats):
+                exit("Rescanned {} vaults".format(len(vaults)))
+        if not args.stats:
+            vaultsUI.print_as_list(vaultsUI.list_vaults())
+            exit(0)
+        vaults = catalog.load()
+        if vaults is None:
+            # First use, or the catalog was removed
+            vaults = catalog.rescan()
+        vaultsUI.print_stats(vaults)
+        exit(0)
+
     # Default operations: 
     # 1. list vaults and let user chose, if none selected
     if not args.vault:
@@ -53,6 +102,18 @@ def cli(args: argparse.Namespace):
                 args.vault = selected
                 return cli(args)
             
+    if args.sync_to:
+        '''Back the vault up to another directory, the ciphertext is copied as is and no password is needed'''
+        if not isvault(args.vault):
+            exit("{} is not a vault".format(args.vault))
+        try:
+            stats = Vault(args.vault).sync_to(args.sync_to)
+        except OSError as err:
+            utils.exit_with(err)
+        print("Synced {} to {} in {:.2f}s: {} copied, {} appended, {} deleted, {} unchanged".format(
+            args.vault, args.sync_to, stats['seconds'], stats['copied'], stats['appended'], stats['deleted'], stats['unchanged']))
+        exit(0)
+
     if args.vault and not isvault(args.vault) and not args.purge:
         '''Setup a new vault to continue operations'''
         args.new = input("Create new? [(y)es/(n)o] ")
@@ -62,20 +123,28 @@ def cli(args: argparse.Namespace):
                 exit("Password mismatch")
             
             tmp = Vault(args.vault)
-            tmp.initialize(encryption.Encryption(localkey))
+            tmp.initialize(encryption.Encryption(localkey, kdf=kdf.load_defaults(default_kdf_file)))
             del localkey
             print("Created {}".format(str(tmp)))
             del tmp
         else:
             exit(0)
             
-    # authenticate to unlock the vault
+    # authenticate to unlock the vault, asking the key agent first
     try:
-        unlocked = unlock(Vault(args.vault), prompt_password('Unlock vault: '))
-        if not unlocked:
-            raise LockedError()
-        session.vault = unlocked
-        del unlocked
+        session.vault = Vault(args.vault)
+        with profiling.phase('cli.agent'):
+            key = agent.get_key(session.vault)
+        if not key or not session.vault.unlock_key(key):
+            with profiling.phase('cli.prompt'):
+                password = prompt_password('Unlock vault: ')
+            unlocked = unlock(session.vault, password)
+            del password
+            if not unlocked:
+                raise LockedError()
+            agent.add_key(session.vault, session.vault.crypto.key)
+            del unlocked
+        del key
     except (LockedError, Exception) as err:
         utils.exit_with(err)
         
@@ -91,7 +160,93 @@ def cli(args: argparse.Namespace):
             except Exception as err:
                 utils.exit_with(err)
     
-    # schedule_lock(session.vault)
+    if args.calibrate_kdf:
+        '''Re-wrap the vault's data key with the calibrated parameters'''
+        localkey = prompt_password('Confirm vault password: ')
+        if not Vault(args.vault).unlock(localkey):
+            exit("Wrong password")
+        try:
+            session.vault.change_password(localkey, kdf=params)
+            del localkey
+            agent.remove_key(session.vault)
+            agent.add_key(session.vault, session.vault.crypto.key)
+            exit("{} now uses these parameters".format(session.vault.name))
+        except Exception as err:
+            utils.exit_with(err)
+
+    if args.upgrade or (args.passwd and session.vault.crypto.legacy):
+        '''One-time migration to encrypt secrets with the vault's data key'''
+        try:
+            if session.vault.upgrade(progress=print_progress):
+                print("Upgraded {}".format(session.vault.name))
+            elif args.upgrade:
+                print("{} is up to date".format(session.vault.name))
+        except Exception as err:
+            utils.exit_with(err)
+        if not args.passwd:
+            exit(0)
+
+    if args.passwd:
+        '''Change the master password, only the vault header is rewritten'''
+        localkey = prompt_password('New vault password: ')
+        if not localkey == prompt_password("Confirm you vault password: "):
+            exit("Password mismatch")
+        try:
+            session.vault.change_password(localkey)
+            del localkey
+            agent.remove_key(session.vault)
+            agent.add_key(session.vault, session.vault.crypto.key)
+            exit("Changed password of {}".format(session.vault.name))
+        except Exception as err:
+            utils.exit_with(err)
+
+    if args.migrate_format:
+        '''Move the vault's secrets to another storage format'''
+        try:
+            if session.vault.migrate_format(args.migrate_format):
+                exit("Migrated {} to {} format".format(session.vault.name, args.migrate_format))
+            exit("{} already uses {} format".format(session.vault.name, args.migrate_format))
+        except (ValueError, Exception) as err:
+            utils.exit_with(err)
+
+    if args.migrate_layout:
+        '''Move the secret files of a directory vault to another layout'''
+        try:
+            if session.vault.migrate_layout(args.migrate_layout):
+                exit("Moved {} to the {} layout".format(session.vault.name, args.migrate_layout))
+            exit("{} already uses the {} layout".format(session.vault.name, args.migrate_layout))
+        except (ValueError, Exception) as err:
+            utils.exit_with(err)
+
+    if args.rotate_keys:
+        '''Re-encrypt every secret with a new data key, resuming an interrupted rotation'''
+        try:
+            stats = session.vault.rotate_keys(progress=lambda done, total: print_progress(done, total, "Rotating"))
+        except (ValueError, Exception) as err:
+            utils.exit_with(err)
+        exit("Rotated the data key of {} in {:.2f}s: {} of {} secrets re-encrypted".format(
+            session.vault.name, stats['seconds'], stats['rotated'], stats['total']))
+
+    if args.compact:
+        if session.vault.compact():
+            exit("Compacted {}".format(session.vault.name))
+        exit("{} is not a packed vault".format(session.vault.name))
+
+    if args.verify:
+        '''Check that every secret, or a sample of them, still decrypts'''
+        report = session.vault.verify(sample=args.sample, progress=lambda done, total: print_progress(done, total, "Verifying"))
+        for name, problem in sorted(report['problems'].items()):
+            print("! {}: {}".format(name, problem))
+        for path in report['orphans']:
+            print("! orphan file: {}".format(path))
+        print("Verified {} of {} secrets in {:.2f}s: {} problems, {} orphan files".format(
+            report['checked'], report['total'], report['seconds'], len(report['problems']), len(report['orphans'])))
+        exit(1 if report['problems'] or report['orphans'] else 0)
+
+    if args.batch:
+        '''Apply newline delimited JSON operations from stdin, after this single unlock'''
+        failures = batchUI.run(session.vault, sys.stdin, sys.stdout)
+        exit(1 if failures else 0)
 
     if args.secret:
         '''capture user selected secret from -s or --secret'''
@@ -99,13 +254,37 @@ def cli(args: argparse.Namespace):
 
         if not utils.isvalid_name(session.secret):
             exit("Invalid name provided")
+
+        if args.history:
+            '''Earlier versions of the secret, newest first'''
+            try:
+                versions = session.vault.history(session.secret)
+            except (SecretNotFoundError, LockedError, Exception) as err:
+                utils.exit_with(err)
+            for version, stamp, secret in versions:
+                print("- [{}] replaced {}".format(version, datetime.fromtimestamp(stamp).strftime('%Y-%m-%d %H:%M:%S')))
+            exit("{} earlier versions of {}".format(len(versions), session.secret))
+
+        if args.restore is not None:
+            '''Make an earlier version current again, the current one stays in the history'''
+            try:
+                if session.vault.has_attachment(session.secret):
+                    print("! attachments are not versioned, {} keeps its current file".format(session.secret))
+                if session.vault.restore(session.secret, args.restore):
+                    exit("Restored version {} of {}".format(args.restore, session.secret))
+                exit("Could not restore {}".format(session.secret))
+            except (SecretNotFoundError, LockedError, Exception) as err:
+                utils.exit_with(err)
             
         if args.export:
             '''Exporting a secret'''
             
             try:
                 data = session.vault.read(session.secret)
-                if args.export == 'stdout':
+                if 'attachment' in data.extras and session.vault.has_attachment(session.secret):
+                    '''Attachments are streamed out, never held in memory'''
+                    export_attachment(session.vault, session.secret, args.export)
+                elif args.export == 'stdout':
                     '''echo out the secret'''
                     print(str(data))
                 else:
@@ -143,9 +322,10 @@ def cli(args: argparse.Namespace):
         if os.path.exists(args.store[1]):
             '''Is this a file to digest?'''
             try:
-                with open(args.store[1], 'r') as f:
-                    x = f.read()
-                    tmp_secret = Secret(secret_name, value=x)
+                with open(args.store[1], 'rb') as f:
+                    if session.vault.store_file(secret_name, f):
+                        exit('Stored {}'.format(secret_name))
+                    exit("Could not store {}".format(secret_name))
             except (PermissionError, Exception) as ex:
                 utils.exit_with(ex)
         else:
@@ -183,30 +363,74 @@ def cli(args: argparse.Namespace):
         # Default operations: 
         # 2. list secrets of the select vault and output selected secret
         while True:
-            selected = vaultsUI.list_vault_and_select(session.vault)
+            selected = vaultsUI.list_vault_and_select(session.vault, search=args.search, category=args.category, tag=args.tag)
             if selected:
                 args.secret = selected
                 args.export = "stdout"
                 args.list_secrets = False
                 return cli(args)
 
+def print_profile(fmt: str, started: float):
+    '''Per phase timings, on stderr so exported secrets on stdout stay untouched'''
+    profiling.record('cli.total', time.perf_counter() - started)
+    phases = profiling.report()
+    if fmt == 'json':
+        print(json.dumps(phases, indent=4), file=sys.stderr)
+    else:
+        print("\n" + profiling.format_report(phases), file=sys.stderr)
+
 def main():
+    started = time.perf_counter()
+    if sys.argv[1:2] == ['agent']:
+        '''`fernetvault agent` runs the key agent'''
+        return agent.main(sys.argv[2:])
+    if sys.argv[1:2] == ['serve']:
+        '''`fernetvault serve` runs the secret-serving daemon'''
+        from . import server
+        return server.main(sys.argv[2:])
+
     parser = argparse.ArgumentParser()
     # Vault selection and operations
     parser.add_argument('vault', help="Select a vault", type=str, nargs='?', const='')
+    parser.add_argument('--vaults', help="List vaults", action='store_true')
+    parser.add_argument('--stats',  help="List vaults with their number of secrets, size and last change", action='store_true')
+    parser.add_argument('--rescan', help="Rebuild the vault catalog behind --stats from the vault directories", action='store_true')
     parser.add_argument('--purge',  help="Purge vault", action='store_true')
     parser.add_argument('--list',   help="List vault", action='store_true', dest="list_secrets")
+    parser.add_argument('--migrate-format', dest="migrate_format", help="Convert the vault to another storage format", choices=['directory', 'packed'])
+    parser.add_argument('--migrate-layout', dest="migrate_layout", help="Spread a directory vault's secret files over hashed subdirectories, or back", choices=['flat', 'sharded'])
+    parser.add_argument('--compact', help="Reclaim unused space in a packed vault", action='store_true')
+    parser.add_argument('--passwd', help="Change the vault password", action='store_true')
+    parser.add_argument('--rotate-keys', dest="rotate_keys", help="Re-encrypt the vault's secrets with a new data key, resuming an interrupted rotation", action='store_true')
+    parser.add_argument('--upgrade', help="Encrypt secrets of an older vault with its data key", action='store_true')
+    # Key derivation
+    parser.add_argument('--calibrate-kdf', dest="calibrate_kdf", help="Pick KDF parameters for this machine, for new vaults or the selected vault", action='store_true')
+    parser.add_argument('--target-ms', dest="target_ms", help="Target unlock time for --calibrate-kdf", type=int, default=250)
+    parser.add_argument('--kdf', help="Key derivation function for --calibrate-kdf", choices=kdf.algorithms, default=kdf.PBKDF2)
+    parser.add_argument('--category', help="Only list secrets in this category", type=str)
+    parser.add_argument('--tag',      help="Only list secrets with this tag", type=str)
+    parser.add_argument('--search',   help="Only list secrets containing these words, best matches first", type=str, metavar='TERM')
     # Secrets
     parser.add_argument('-s', '--secret', dest='secret', help="Select a secret", type=str)
     parser.add_argument('-rm', '--remove',  help="Remove selected secret", action='store_true')
+    parser.add_argument('--history', help="List earlier versions of the selected secret", action='store_true')
+    parser.add_argument('--restore', help="Make this earlier version of the selected secret current again", type=int, metavar='N')
     parser.add_argument('-o', '--out', '--export', dest="export", help="Export secret to specified file", type=str, nargs='?', default='stdout', const='stdout')
     # Secrets: Create secrets
     parser.add_argument('-st', '--store', dest="store", help="Secret name and content to store", nargs=2, metavar=('name', 'content'), type=str)
     parser.add_argument('--interactive',  help="Add secrets interactively", action='store_true')
+    parser.add_argument('--sync-to', dest="sync_to", help="Copy the vault's encrypted files to this directory, only what changed since the last sync")
+    parser.add_argument('--verify', help="Check that every secret of the vault decrypts", action='store_true')
+    parser.add_argument('--sample', help="Only verify this many randomly chosen secrets", type=int)
+    parser.add_argument('--batch', help="Apply JSON store/read/remove operations, one per line, from stdin", action='store_true')
     # Debug and verbosity
     parser.add_argument('--debug', dest="debug", help="Activate debug mode", action='store_true')
+    parser.add_argument('--profile', help="Print time spent per phase on exit, as a table or JSON", nargs='?', const='text', choices=['text', 'json'])
 
     args = parser.parse_args()
+    if args.profile:
+        profiling.enable()
+        atexit.register(print_profile, args.profile, started)
     
     cli(args)
 
@@ -0,0 +1,94 @@
+import asyncio
+import base64
+import functools
+import threading
+
+from .secret import Secret
+from .vault import Vault, LockedError
+
+from ..crypto import encryption, kdf
+
+
+class AsyncVault:
+    '''
+        Awaitable front for a `Vault`, for use inside asyncio services
+
+        File I/O and Fernet work run on `executor` (the loop's default thread pool when None).
+        The key derivation of `unlock` runs on `kdf_executor`, pass a `ProcessPoolExecutor` to keep
+        it off the threads serving reads. State, on-disk format and locking are those of the wrapped `Vault`
+    '''
+
+    def __init__(self, name: str, executor=None, kdf_executor=None, **kwargs):
+        self.vault = kwargs.pop('vault', None) or Vault(name, **kwargs)
+        self.executor = executor
+        self.kdf_executor = kdf_executor if kdf_executor is not None else executor
+        # Reads run concurrently, writes update the index and are serialized
+        self._writing = threading.Lock()
+
+    @classmethod
+    def wrap(cls, vault: Vault, executor=None, kdf_executor=None):
+        return cls(vault.name, executor=executor, kdf_executor=kdf_executor, vault=vault)
+
+    @property
+    def name(self) -> str:
+        return self.vault.name
+
+    async def _run(self, executor, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+    def _locked(self, fn, *args, **kwargs):
+        with self._writing:
+            return fn(*args, **kwargs)
+
+    async def unlock(self, mkey: str) -> bool:
+        version, params, salt, ekey = await self._run(self.executor, encryption.read_header, self.vault.cfg)
+        try:
+            derived = await self._run(self.kdf_executor, kdf.derive, mkey.encode(), salt, params['kdf'])
+        except Exception:
+            return False
+        return await self.unlock_key(base64.urlsafe_b64encode(derived))
+
+    async def unlock_key(self, key: bytes) -> bool:
+        return await self._run(self.executor, self.vault.unlock_key, key)
+
+    def lock(self):
+        self.vault.lock()
+
+    def isunlocked(self) -> bool:
+        return self.vault.isunlocked()
+
+    async def read(self, secret: str) -> Secret:
+        return await self._run(self.executor, self.vault.read, secret)
+
+    async def read_many(self, names, concurrency: int = 32) -> list:
+        '''Read secrets concurrently, returns them in the order of `names`, None for missing ones'''
+        if not self.isunlocked():
+            raise LockedError()
+        limit = asyncio.Semaphore(concurrency)
+
+        async def read(name):
+            async with limit:
+                return await self._run(self.executor, self.vault._read, name)
+        return await asyncio.gather(*(read(name) for name in names))
+
+    async def store(self, secret: Secret) -> bool:
+        return await self._run(self.executor, self._locked, self.vault.store, secret)
+
+    async def store_many(self, secrets, workers: int = None) -> list:
+        return await self._run(self.executor, self._locked, self.vault.store_many, list(secrets), workers)
+
+    async def remove(self, secret: str) -> bool:
+        return await self._run(self.executor, self._locked, self.vault.remove, secret)
+
+    async def list(self) -> list:
+        return await self._run(self.executor, self.vault.list)
+
+    async def query(self, **filters) -> list:
+        return await self._run(self.executor, self._locked, self.vault.query, **filters)
+
+    async def search(self, text: str, limit: int = None) -> list:
+        return await self._run(self.executor, self._locked, self.vault.search, text, limit)
+
+    def __str__(self):
+        return str(self.vault)
@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+
+from .secret import Secret
+
+
+class SecretCache:
+    '''
+        In-process LRU cache of decrypted secrets
+
+        Bounded by entry count, plaintext bytes and age. Entries are only served while the secret's
+        storage modification stamp is unchanged, so writes from other processes are never hidden
+    '''
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024, ttl: float = 300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # name -> (secret, mtime, size, expiry)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, name: str, mtime: float):
+        '''A copy of the cached secret, or None if missing, expired or stale'''
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is None or entry[1] != mtime or entry[3] < time.monotonic():
+                if entry is not None:
+                    self._drop(name)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(name)
+            self.hits += 1
+            secret = entry[0]
+        # Callers may modify what they get back
+        return secret.copy()
+
+    def put(self, name: str, secret: Secret, mtime: float, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if name in self.entries:
+                self._drop(name)
+            self.entries[name] = (secret.copy(), mtime, size, time.monotonic() + self.ttl)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, name: str):
+        with self._lock:
+            if name in self.entries:
+                self._drop(name)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _drop(self, name: str):
+        self.bytes -= self.entries.pop(name)[2]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
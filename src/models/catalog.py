@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+import time
+
+from .constants import default_catalog, default_vault_dir
+from .locking import VaultLocks
+from ..utils import atomic_write
+
+
+class Catalog:
+    '''
+        Unencrypted summary of the vaults under `~/.vaults`, for listing them without opening any
+
+        Holds the number of secrets, the bytes of their tokens and the last modification time of
+        every vault, keyed by name. The file is a JSON snapshot followed by JSON deltas, one per line,
+        appended as vaults change and folded back into a single snapshot once they pile up, so
+        reading it takes the same time however often vaults change. A missing catalog is never
+        updated incrementally, `rescan` rebuilds it from the vault directories
+    '''
+    # Bytes of deltas appended to the catalog before it is rewritten as a single snapshot
+    max_delta_bytes = 32 * 1024
+
+    def __init__(self, path: str = default_catalog):
+        self.path = path
+        # Appends and rewrites take turns with other threads and processes, readers never wait
+        self.locks = VaultLocks(os.path.dirname(path))
+        # name -> [secrets, bytes] changed but not yet appended
+        self.pending = {}
+        self._pending = threading.Lock()
+
+    def load(self) -> dict:
+        '''name -> {'secrets', 'bytes', 'mtime'}, None when there is no catalog'''
+        try:
+            with open(self.path, 'rb') as f:
+                return self._parse(f.read())
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _parse(data: bytes) -> dict:
+        lines = data.split(b'\n')
+        vaults = json.loads(lines[0])
+        for line in lines[1:]:
+            try:
+                delta = json.loads(line)
+            except ValueError:
+                # Torn or still being appended
+                continue
+            vaults.update(delta.get('set', {}))
+            for name, (secrets, size, mtime) in delta.get('add', {}).items():
+                # Vaults left out of the catalog stay out until the next rescan
+                if name in vaults:
+                    entry = vaults[name]
+                    entry.update(secrets=entry['secrets'] + secrets, bytes=entry['bytes'] + size, mtime=mtime)
+            for name in delta.get('del', []):
+                vaults.pop(name, None)
+        return vaults
+
+    def save(self, vaults: dict):
+        '''Rewrite the catalog as a single snapshot'''
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.locks.hold(0, exclusive=True):
+            self._save(vaults)
+
+    def _save(self, vaults: dict):
+        atomic_write(self.path, json.dumps(vaults, separators=(',', ':')).encode())
+
+    def set(self, name: str, secrets: int = 0, size: int = 0, mtime: float = None):
+        self._append({'set': {name: {'secrets': secrets, 'bytes': size, 'mtime': mtime or time.time()}}})
+
+    def change(self, name: str, secrets: int, size: int):
+        '''Count `secrets` more secrets and `size` more bytes for vault `name` on the next `flush`'''
+        with self._pending:
+            counts = self.pending.setdefault(name, [0, 0])
+            counts[0] += secrets
+            counts[1] += size
+
+    def flush(self):
+        with self._pending:
+            pending, self.pending = self.pending, {}
+        if pending:
+            now = time.time()
+            self._append({'add': {name: [secrets, size, now] for name, (secrets, size) in pending.items()}})
+
+    def drop(self, name: str):
+        self._append({'del': [name]})
+
+    def _append(self, delta: dict):
+        line = b'\n' + json.dumps(delta, separators=(',', ':')).encode()
+        with self.locks.hold(0, exclusive=True):
+            try:
+                with open(self.path, 'rb') as f:
+                    snapshot = len(f.readline())
+            except FileNotFoundError:
+                return
+            if not snapshot:
+                return
+            with open(self.path, 'ab') as f:
+                f.write(line)
+                if f.tell() - snapshot <= self.max_delta_bytes:
+                    return
+            with open(self.path, 'rb') as f:
+                self._save(self._parse(f.read()))
+
+    def rescan(self, base_dir: str = default_vault_dir) -> dict:
+        '''Rebuild the catalog from the vault directories under `base_dir`'''
+        # Imported here, vaults update the catalog
+        from .vault import Vault
+
+        vaults = {}
+        for name in sorted(os.listdir(base_dir)):
+            # Only vault directories, with their header, not backups or other directories put there
+            if not name.startswith('.') and os.path.isfile(os.path.join(base_dir, name, "{}.cfg".format(name))):
+                vaults[name] = Vault(name, dir=os.path.join(base_dir, name)).stats()
+        self.save(vaults)
+        return vaults
@@ -3,6 +3,8 @@ from os import path
 
 default_vault_dir = path.expanduser('~') + '/.vaults/'
 default_config_dir = path.join(str(default_vault_dir), ".config")
+default_kdf_file = path.join(default_config_dir, "kdf.json")
+default_catalog = path.join(default_config_dir, "catalog.jsonl")
 
 def default_dir(vault: str) -> str:
     return path.join(default_vault_dir, vault)
@@ -0,0 +1,102 @@
+import os
+import time
+import zlib
+
+from ..utils import atomic_write, GroupCommit
+
+
+class History:
+    '''
+        Earlier versions of a secret, oldest first, one encrypted record per line
+
+        A record holds the number of the version, when it was replaced, and its payload compressed
+        with the payload of the next newer version as preset dictionary, so a version mostly costs
+        what changed. Versions are rebuilt from the current payload backwards. The current version
+        is never stored here, reading it costs nothing extra
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def tokens(self) -> list:
+        try:
+            with open(self.path, 'rb') as f:
+                return [t for t in f.read().split(b'\n') if t]
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _parse(record: bytes) -> tuple:
+        version, stamp, delta = record.split(b'\t', 2)
+        return int(version), float(stamp), delta
+
+    def records(self, crypto) -> list:
+        '''(version, replaced at, delta) of every kept version, oldest first'''
+        return [self._parse(crypto.decrypt(token)) for token in self.tokens()]
+
+    def append(self, crypto, older: bytes, newer: bytes, keep: int, max_age: float = None, group: GroupCommit = None):
+        '''Record payload `older` as replaced by `newer`, then `prune`'''
+        tokens = self.tokens()
+        try:
+            version = self._parse(crypto.decrypt(tokens[-1]))[0] + 1 if tokens else 1
+        except Exception:
+            # Torn or damaged, start the history over
+            tokens, version = [], 1
+        packer = zlib.compressobj(9, zdict=newer[-32768:])
+        delta = packer.compress(older) + packer.flush()
+        token = crypto.encrypt(b'%d\t%r\t' % (version, time.time()) + delta)
+        tokens.append(token)
+        if not self.prune(crypto, keep, max_age, group, tokens):
+            # Replaced rather than appended to, as every vault file is, so backups see the change
+            self._rewrite(tokens, group)
+
+    def prune(self, crypto, keep: int, max_age: float = None, group: GroupCommit = None, tokens: list = None) -> bool:
+        '''Drop versions beyond the newest `keep`, and those replaced more than `max_age` seconds ago'''
+        tokens = self.tokens() if tokens is None else tokens
+        drop = max(0, len(tokens) - keep)
+        if max_age is not None:
+            expired = time.time() - max_age
+            # Oldest first, only the expired ones need decrypting
+            while drop < len(tokens) and self._parse(crypto.decrypt(tokens[drop]))[1] < expired:
+                drop += 1
+        if drop:
+            self._rewrite(tokens[drop:], group)
+        return drop > 0
+
+    def versions(self, crypto, current: bytes) -> list:
+        '''
+            (version, replaced at, payload) of every kept version, newest first
+
+            A damaged record ends the list, versions older than it can no longer be rebuilt
+        '''
+        rebuilt = []
+        newer = current
+        for token in reversed(self.tokens()):
+            try:
+                version, stamp, delta = self._parse(crypto.decrypt(token))
+                unpacker = zlib.decompressobj(zdict=newer[-32768:])
+                newer = unpacker.decompress(delta) + unpacker.flush()
+            except Exception:
+                break
+            rebuilt.append((version, stamp, newer))
+        return rebuilt
+
+    def rewrap(self, rotate, group: GroupCommit = None):
+        '''Re-encrypt every record with `rotate`'''
+        tokens = self.tokens()
+        if tokens:
+            self._rewrite([rotate(token) for token in tokens], group)
+
+    def _rewrite(self, tokens: list, group: GroupCommit = None):
+        if not tokens:
+            self.delete()
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        atomic_write(self.path, b'\n'.join(tokens), group)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,215 @@
+import json
+import os
+
+from .secret import Secret
+from ..utils import atomic_write
+
+
+class Index:
+    '''
+        Encrypted metadata index of a vault's secrets
+
+        Holds `category`, `tags`, `url` and `mtime` of every secret, keyed by name,
+        so listing and filtering never need to decrypt the secrets themselves
+    '''
+    fields = ('category', 'tags', 'url')
+
+    # Deltas appended to the index file before it is rewritten as a single snapshot
+    max_deltas = 256
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.changes = {}
+        self.deltas = 0
+        self.loaded = False
+        # (inode, size) of the index file as last read or written here
+        self.stamp = None
+
+    def load(self, crypto) -> bool:
+        '''
+            Decrypt the index file, returns False when there is none or it is unreadable
+
+            The file holds an encrypted snapshot followed by encrypted deltas, one token per line
+        '''
+        self.entries = {}
+        self.changes = {}
+        self.deltas = 0
+        self.loaded = True
+        self.stamp = None
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                self.stamp = (st.st_ino, st.st_size)
+                tokens = [t for t in f.read().split(b'\n') if t]
+            self.entries = json.loads(crypto.decrypt(tokens[0]))
+        except Exception:
+            self.entries = {}
+            return False
+
+        self.deltas = len(tokens) - 1
+        for token in tokens[1:]:
+            try:
+                delta = json.loads(crypto.decrypt(token))
+            except Exception:
+                # Torn append, rewrite a clean snapshot on the next flush
+                self.deltas = self.max_deltas
+                break
+            self.entries.update(delta.get('set', {}))
+            for name in delta.get('del', []):
+                self.entries.pop(name, None)
+        return True
+
+    def save(self, crypto):
+        '''Rewrite the index file as a single snapshot'''
+        atomic_write(self.path, crypto.encrypt(json.dumps(self.entries, separators=(',', ':'))))
+        self.changes = {}
+        self.deltas = 0
+        self.stamp = self._stat()
+
+    def flush(self, crypto):
+        '''
+            Persist pending changes, appended as one delta until too many deltas pile up
+
+            An index that was never loaded is not read back to append a delta, only its last delta is,
+            for the number of deltas. Readers pick up secrets missing from it through `sync`
+        '''
+        if not self.changes:
+            return
+        if not self.loaded:
+            if not os.path.exists(self.path):
+                self.entries = {name: entry for name, entry in self.changes.items() if entry is not None}
+                self.save(crypto)
+                self.entries = {}
+                return
+            self.deltas = self._counted(crypto)
+            if self.deltas >= self.max_deltas:
+                # Folded into a single snapshot, with the changes made here
+                self._merge(crypto)
+                return self.save(crypto)
+        elif self.deltas >= self.max_deltas or not os.path.exists(self.path):
+            if self.loaded and self._stat() != self.stamp:
+                # Written by another process since it was read, keep its changes in the new snapshot
+                self._merge(crypto)
+            return self.save(crypto)
+
+        delta = {
+            'set': {name: entry for name, entry in self.changes.items() if entry is not None},
+            'del': [name for name, entry in self.changes.items() if entry is None],
+            # Numbered, so processes that never load the index know how many deltas piled up
+            'n': self.deltas + 1,
+        }
+        record = b'\n' + crypto.encrypt(json.dumps(delta, separators=(',', ':')))
+        with open(self.path, 'ab') as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+        if self.stamp == (st.st_ino, st.st_size - len(record)):
+            # Nothing but this delta was added since
+            self.stamp = (st.st_ino, st.st_size)
+        self.changes = {}
+        self.deltas += 1
+
+    def _counted(self, crypto) -> int:
+        '''Number of deltas in the index file, read from the last one alone, without reading the snapshot'''
+        chunks = []
+        try:
+            with open(self.path, 'rb') as f:
+                position = f.seek(0, os.SEEK_END)
+                while position > 0:
+                    step = min(4096, position)
+                    position -= step
+                    f.seek(position)
+                    chunk = f.read(step)
+                    cut = chunk.rfind(b'\n')
+                    if cut >= 0:
+                        record = chunk[cut + 1:] + b''.join(reversed(chunks))
+                        break
+                    chunks.append(chunk)
+                else:
+                    # The snapshot alone
+                    return 0
+            return int(json.loads(crypto.decrypt(record))['n'])
+        except Exception:
+            # Torn, or written before deltas were numbered, rewrite a clean snapshot
+            return self.max_deltas
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size)
+
+    def _merge(self, crypto):
+        '''Read the index file again, then apply pending changes over it'''
+        changes = self.changes
+        self.load(crypto)
+        for name, entry in changes.items():
+            if entry is None:
+                self.discard(name)
+            else:
+                self.entries[name] = entry
+                self.changes[name] = entry
+
+    def add(self, secret: Secret, mtime: float):
+        entry = {field: getattr(secret, field, None) for field in self.fields}
+        entry['mtime'] = mtime
+        if self.loaded:
+            self.entries[secret.name] = entry
+        self.changes[secret.name] = entry
+
+    def touch(self, name: str, mtime: float):
+        '''Record the new modification stamp of a secret rewritten with the same contents'''
+        entry = self.entries.get(name)
+        if entry is not None:
+            entry = dict(entry, mtime=mtime)
+            self.entries[name] = entry
+            self.changes[name] = entry
+
+    def discard(self, name: str):
+        if not self.loaded:
+            # Unknown whether it was indexed, record the removal anyway
+            self.changes[name] = None
+            return
+        if self.entries.pop(name, None) is not None:
+            self.changes[name] = None
+
+    def stale(self, mtimes: dict) -> list:
+        '''Names whose secret file is missing from the index or changed since it was indexed'''
+        return [name for name, mtime in mtimes.items()
+                if name not in self.entries or self.entries[name].get('mtime') != mtime]
+
+    def sync(self, mtimes: dict, read) -> bool:
+        '''
+            Bring the index in line with `mtimes` (name -> secret mtime)
+
+            Only missing or changed secrets are read back through `read`. Returns True if the index changed
+        '''
+        changed = False
+        for name in [n for n in self.entries if n not in mtimes]:
+            self.discard(name)
+            changed = True
+        for name in self.stale(mtimes):
+            try:
+                self.add(read(name), mtimes[name])
+                changed = True
+            except Exception:
+                # Unreadable secrets are left out of the index
+                continue
+        return changed
+
+    def query(self, category: str = None, tag: str = None, url_contains: str = None) -> list:
+        matches = []
+        for name, entry in self.entries.items():
+            if category is not None and entry.get('category') != category:
+                continue
+            if tag is not None and tag not in (entry.get('tags') or []):
+                continue
+            if url_contains is not None and url_contains not in (entry.get('url') or ''):
+                continue
+            matches.append(name)
+        return sorted(matches)
@@ -0,0 +1,173 @@
+'''
+    Advisory locks between processes sharing a vault directory
+
+    All locks are byte ranges of a single `.lock` file in the vault directory, taken with `fcntl.lockf`:
+    byte 0 locks the whole vault, shared by everyday operations and exclusive for structural ones
+    such as purge or migrations, bytes 1 and 2 guard the index files and the pack of packed vaults,
+    byte 3 is held by key rotations, and each secret locks a byte of its own past those, shared to read
+    and exclusive to write.
+
+    POSIX record locks belong to a process, not a thread, and closing any descriptor of the lock file
+    drops them all, so a process keeps a single descriptor and hold table per lock file, shared by every
+    `VaultLocks` of that directory. Threads share each lock through a count, with a thread holding a lock
+    exclusively free to take it again. Platforms without `fcntl` run unlocked.
+'''
+import contextlib
+import os
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+VAULT = 0
+INDEX = 1
+PACK = 2
+ROTATION = 3
+# Secret bytes start past the reserved ones
+_secrets = 16
+
+
+class _Hold:
+    __slots__ = ('exclusive', 'owner', 'count', 'granted', 'failed')
+
+    def __init__(self, exclusive: bool, owner: int):
+        self.exclusive = exclusive
+        self.owner = owner
+        self.count = 1
+        self.granted = threading.Event()
+        self.failed = False
+
+
+class _LockFile:
+    '''Descriptor and holds of one lock file, for the whole process'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = None
+        self.pid = os.getpid()
+        self.cond = threading.Condition()
+        # offset -> _Hold, for locks held or being taken by this process
+        self.held = {}
+
+
+# Real path of a lock file -> its _LockFile
+_files = {}
+_files_lock = threading.Lock()
+
+
+def _lock_file(path: str) -> _LockFile:
+    path = os.path.realpath(path)
+    with _files_lock:
+        if path not in _files:
+            _files[path] = _LockFile(path)
+        return _files[path]
+
+
+class VaultLocks:
+    name = '.lock'
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, self.name)
+        self._file = _lock_file(self.path)
+
+    def vault(self, exclusive: bool = False):
+        '''The whole vault, exclusive for operations that move or remove many files'''
+        return self.hold(VAULT, exclusive)
+
+    def index(self, exclusive: bool = False):
+        return self.hold(INDEX, exclusive)
+
+    def pack(self):
+        '''Appends to, and rewrites of, a packed vault'''
+        return self.hold(PACK, True)
+
+    def rotation(self):
+        '''Held throughout a key rotation, one at a time'''
+        return self.hold(ROTATION, True)
+
+    def secret(self, name: str, exclusive: bool = False):
+        return self.hold(_secrets + zlib.crc32(name.encode()), exclusive)
+
+    @contextlib.contextmanager
+    def hold(self, offset: int, exclusive: bool = False):
+        if fcntl is None or not self._acquire(offset, exclusive):
+            # No lock file, the vault directory is not there (yet)
+            yield
+            return
+        try:
+            yield
+        finally:
+            self._release(offset)
+
+    def _open(self):
+        lock = self._file
+        if lock.fd is None:
+            try:
+                lock.fd = os.open(lock.path, os.O_RDWR | os.O_CREAT, 0o600)
+            except FileNotFoundError:
+                return None
+        return lock.fd
+
+    def _acquire(self, offset: int, exclusive: bool) -> bool:
+        me = threading.get_ident()
+        lock = self._file
+        with lock.cond:
+            if lock.pid != os.getpid():
+                # Forked, record locks are not inherited
+                lock.fd, lock.pid, lock.held = None, os.getpid(), {}
+            while True:
+                hold = lock.held.get(offset)
+                if hold is None:
+                    fd = self._open()
+                    if fd is None:
+                        return False
+                    hold = lock.held[offset] = _Hold(exclusive, me)
+                    first = True
+                    break
+                if hold.exclusive and hold.owner == me:
+                    hold.count += 1
+                    return True
+                if not exclusive and not hold.exclusive:
+                    hold.count += 1
+                    first = False
+                    break
+                lock.cond.wait()
+
+        if not first:
+            hold.granted.wait()
+            if hold.failed:
+                raise OSError("Could not lock {}".format(self.path))
+            return True
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, 1, offset)
+        except BaseException:
+            with lock.cond:
+                del lock.held[offset]
+                hold.failed = True
+                hold.granted.set()
+                lock.cond.notify_all()
+            raise
+        hold.granted.set()
+        return True
+
+    def _release(self, offset: int):
+        lock = self._file
+        with lock.cond:
+            hold = lock.held[offset]
+            hold.count -= 1
+            if hold.count:
+                return
+            del lock.held[offset]
+            fcntl.lockf(lock.fd, fcntl.LOCK_UN, 1, offset)
+            lock.cond.notify_all()
+
+    def close(self):
+        '''Close the lock file once no lock of this process is held or being taken'''
+        lock = self._file
+        with lock.cond:
+            if lock.fd is not None and not lock.held:
+                os.close(lock.fd)
+                lock.fd = None
@@ -0,0 +1,168 @@
+import bisect
+import math
+import re
+
+from .index import Index
+from .secret import Secret
+
+# Words, and words joined by `-`, `.` or `_` such as host names, e.g. both `db`, `prod`, `3` and `db-prod-3`
+_words = re.compile(r'[^\W_]+')
+_chunks = re.compile(r'[\w.-]+')
+# Longer words, such as keys or encoded blobs, are not indexed
+max_word = 64
+
+# Weight of a term per field it appears in, custom fields weigh as much as notes
+weights = {'name': 4, 'tags': 3, 'category': 2, 'url': 2, 'notes': 1, 'extras': 1}
+# Share of the score kept when a query word only matches the start of a term
+prefix_weight = 0.5
+
+
+def split(text: str):
+    '''(words, joined words) of `text`'''
+    words, compounds = set(), set()
+    for chunk in _chunks.findall(text.lower()):
+        found = _words.findall(chunk)
+        words.update(w for w in found if len(w) <= max_word)
+        chunk = chunk.strip('._-')
+        if len(found) > 1 and len(chunk) <= max_word:
+            compounds.add(chunk)
+    return words, compounds
+
+
+def tokenize(text: str) -> set:
+    words, compounds = split(text)
+    return words | compounds
+
+
+def query_words(text: str) -> set:
+    '''Words of a search, joined words are looked up as a whole'''
+    words, compounds = split(text)
+    joined = {word for compound in compounds for word in _words.findall(compound)}
+    return compounds | (words - joined)
+
+
+def strings(value):
+    '''Every string and number within a custom field value'''
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, bool) or value is None:
+        return
+    elif isinstance(value, (int, float)):
+        yield str(value)
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from strings(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            yield from strings(v)
+
+
+class SearchIndex(Index):
+    '''
+        Encrypted inverted index of the words of a vault's secrets
+
+        Holds, per secret, the words of its name, URL, category, tags, notes and custom fields with their weights,
+        so searches are answered without decrypting any secret. Persisted like the metadata index,
+        as an encrypted snapshot followed by encrypted deltas.
+
+        Secrets stored before the index was loaded are recorded as deltas without reading it back,
+        as they are in the metadata index. Searches pick up anything missed through `sync`
+    '''
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        # word -> {name: weight}, and its words in sorted order for prefix lookups, built on first search
+        self.postings = None
+        self.words = []
+
+    def load(self, crypto) -> bool:
+        self.postings = None
+        self.words = []
+        return super().load(crypto)
+
+    def add(self, secret: Secret, mtime: float):
+        terms = {}
+        for field in ('name', 'url', 'category', 'notes'):
+            for word in tokenize(getattr(secret, field) or ''):
+                terms[word] = terms.get(word, 0) + weights[field]
+        for tag in secret.tags or []:
+            for word in tokenize(str(tag)):
+                terms[word] = terms.get(word, 0) + weights['tags']
+        for value in strings(secret.extras):
+            for word in tokenize(value):
+                terms[word] = terms.get(word, 0) + weights['extras']
+
+        self._unpost(secret.name)
+        entry = {'mtime': mtime, 'terms': terms}
+        if self.loaded:
+            self.entries[secret.name] = entry
+        self.changes[secret.name] = entry
+        self._post(secret.name, terms)
+
+    def discard(self, name: str):
+        self._unpost(name)
+        super().discard(name)
+
+    def _post(self, name: str, terms: dict):
+        if self.postings is None:
+            return
+        for word, weight in terms.items():
+            posting = self.postings.get(word)
+            if posting is None:
+                posting = self.postings[word] = {}
+                bisect.insort(self.words, word)
+            posting[name] = weight
+
+    def _unpost(self, name: str):
+        if self.postings is None or name not in self.entries:
+            return
+        for word in self.entries[name]['terms']:
+            # Emptied words stay listed, they match nothing
+            self.postings.get(word, {}).pop(name, None)
+
+    def _build(self):
+        self.postings = {}
+        for name, entry in self.entries.items():
+            for word, weight in entry['terms'].items():
+                self.postings.setdefault(word, {})[name] = weight
+        self.words = sorted(self.postings)
+
+    def matching(self, word: str):
+        '''Indexed words starting with `word`'''
+        i = bisect.bisect_left(self.words, word)
+        while i < len(self.words) and self.words[i].startswith(word):
+            yield self.words[i]
+            i += 1
+
+    def search(self, text: str, limit: int = None) -> list:
+        '''
+            (name, score) of the secrets holding every word of `text`, best first
+
+            Each word also matches longer words starting with it, scored lower than exact matches.
+            Rarer words weigh more, and so do words found in names, tags and categories over notes
+        '''
+        if self.postings is None:
+            self._build()
+        total = len(self.entries) or 1
+        scores = None
+        for word in query_words(text):
+            found = {}
+            for indexed in self.matching(word):
+                posting = self.postings[indexed]
+                if not posting:
+                    continue
+                idf = math.log(1 + total / len(posting))
+                share = 1.0 if indexed == word else prefix_weight
+                for name, weight in posting.items():
+                    score = weight * idf * share
+                    if score > found.get(name, 0):
+                        found[name] = score
+            if scores is None:
+                scores = found
+            else:
+                scores = {name: score + found[name] for name, score in scores.items() if name in found}
+            if not scores:
+                return []
+
+        ranked = sorted((scores or {}).items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit] if limit is not None else ranked
@@ -1,30 +1,161 @@
+import copy
 import json
+import sys
+import zlib
 
 from ..utils import sanitize_name
 
+# Stored payloads: a format byte, a codec byte, then a body, compressed or not.
+# Format 2 bodies are the compact JSON of the core fields and, after a newline, of the custom fields.
+# Format 1 bodies are a single compact JSON object.
+# Payloads of older versions are the pretty-printed JSON of `__str__`, and always start with `{`
+FORMAT = 2
+RAW = b'j'
+ZLIB = b'z'
+LZMA = b'x'
+compressions = {'zlib': ZLIB, 'lzma': LZMA}
+
+_set = object.__setattr__
+
 
 class Secret:
-    def __init__(self, name: str, **kwargs):
-        self.name = sanitize_name(name)
-        self.url = kwargs.get('url', '')
-        self.category = kwargs.get('category', '')
-        self.notes = kwargs.get('notes', '')
-        self.tags = kwargs.get('tags', [])
-
-        for key, value in kwargs.items():
-            setattr(self, key, value)
-    
+    '''
+        A named secret
+
+        `name`, `url`, `category`, `notes` and `tags` are core fields, any other keyword becomes a custom
+        field of `extras`. Custom fields of loaded secrets are only decoded when first used
+    '''
+    __slots__ = ('name', 'url', 'category', 'notes', 'tags', '_extras', '_raw')
+    fields = ('name', 'url', 'category', 'notes', 'tags')
+
+    def __init__(self, name: str, url: str = '', category: str = '', notes: str = '', tags: list = None, **extras):
+        # Slots set directly, skipping `__setattr__`, secrets are built by the thousand when loading a vault
+        _set(self, 'name', sanitize_name(name))
+        _set(self, 'url', url)
+        _set(self, 'category', category)
+        _set(self, 'notes', notes)
+        _set(self, 'tags', [] if tags is None else tags)
+        _set(self, '_extras', extras or None)
+        # Undecoded JSON of the custom fields
+        _set(self, '_raw', None)
+
+    @property
+    def extras(self) -> dict:
+        '''Custom fields'''
+        if self._raw is not None:
+            self._extras = json.loads(self._raw)
+            self._raw = None
+        elif self._extras is None:
+            self._extras = {}
+        return self._extras
+
+    def __getattr__(self, key: str):
+        # Custom fields read as attributes, as they did before they had their own mapping
+        if key.startswith('_') or key in Secret.__slots__:
+            raise AttributeError(key)
+        try:
+            return self.extras[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __setattr__(self, key: str, value):
+        # Core fields are slots, anything else is set as a custom field, as it was before slots
+        if key in Secret.__slots__:
+            object.__setattr__(self, key, value)
+        else:
+            self.extras[key] = value
+
+    def __delattr__(self, key: str):
+        if key in Secret.__slots__:
+            object.__delattr__(self, key)
+            return
+        try:
+            del self.extras[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
     def categorize(self, category: str):
         self.category = category
-    
+
     def tag(self, *tags):
         self.tags = list(tags)
 
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'url': self.url, 'category': self.category, 'notes': self.notes,
+                'tags': self.tags, **self.extras}
+
+    def copy(self):
+        '''Independent copy, without decoding custom fields that were not used yet'''
+        other = Secret.__new__(Secret)
+        for field in ('name', 'url', 'category', 'notes'):
+            _set(other, field, getattr(self, field))
+        _set(other, 'tags', list(self.tags))
+        _set(other, '_raw', self._raw)
+        _set(other, '_extras', copy.deepcopy(self._extras) if self._extras else None)
+        return other
+
     def __str__(self):
-        return json.dumps(self.__dict__, indent=4, )
-        
+        return json.dumps(self.to_dict(), indent=4, )
+
+    def dump(self, compression: str = 'zlib', threshold: int = 1024) -> bytes:
+        '''
+            Compact payload to encrypt, bodies longer than `threshold` bytes are compressed with
+            `compression` (`zlib`, `lzma` or None) when that makes them smaller
+        '''
+        core = [self.name, self.url, self.category, self.notes, self.tags]
+        body = json.dumps(core, separators=(',', ':'), ensure_ascii=False).encode()
+        if self._raw is not None:
+            body += b'\n' + self._raw
+        elif self._extras:
+            body += b'\n' + json.dumps(self._extras, separators=(',', ':'), ensure_ascii=False).encode()
+        codec = RAW
+        if compression and len(body) > threshold:
+            packed = _compress(compressions[compression], body)
+            if len(packed) < len(body):
+                codec, body = compressions[compression], packed
+        return bytes([FORMAT]) + codec + body
+
+    @staticmethod
+    def plain(payload: bytes) -> bytes:
+        '''`payload` as `dump` would have stored it uncompressed, payloads of older versions as they are'''
+        if payload and 1 <= payload[0] <= FORMAT and payload[1:2] != RAW:
+            return payload[:1] + RAW + _decompress(payload[1:2], payload[2:])
+        return bytes(payload)
+
     @staticmethod
     def load(secret):
+        '''A secret from a `dump` payload or from JSON, as stored by older versions'''
+        if isinstance(secret, (bytes, bytearray)) and secret and 1 <= secret[0] <= FORMAT:
+            version, secret = secret[0], _decompress(secret[1:2], secret[2:])
+            if version == 2:
+                # JSON escapes newlines within strings, the first one ends the core fields
+                core, _, raw = secret.partition(b'\n')
+                name, url, category, notes, tags = json.loads(core)
+                # Categories and tags repeat across secrets, share one copy of each
+                loaded = Secret(name, url, _shared(category), notes, [_shared(t) for t in tags])
+                _set(loaded, '_raw', raw or None)
+                return loaded
         s = json.loads(secret)
         return Secret(**s)
-        
\ No newline at end of file
+
+
+def _shared(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _compress(codec: bytes, body: bytes) -> bytes:
+    if codec == ZLIB:
+        return zlib.compress(body)
+    import lzma
+    return lzma.compress(body, preset=6)
+
+
+def _decompress(codec: bytes, body: bytes) -> bytes:
+    if codec == RAW:
+        return body
+    if codec == ZLIB:
+        return zlib.decompress(body)
+    if codec == LZMA:
+        import lzma
+        return lzma.decompress(body)
+    raise ValueError("Unknown secret payload encoding {!r}".format(codec))
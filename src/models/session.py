@@ -0,0 +1,159 @@
+import base64
+import heapq
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from .vault import Vault, LockedError
+
+from ..crypto import encryption, kdf
+
+
+class SessionManager:
+    '''
+        Many vaults unlocked at once, each locked again after `timeout` without use
+
+        `unlock` runs the key derivation of every vault on a pool of processes, so unlocking
+        a dozen vaults takes about as long as unlocking one per core. Idle deadlines are kept
+        in a heap watched by a single thread, which sleeps until the earliest one and then
+        locks that vault and wipes its keys
+    '''
+
+    def __init__(self, timeout: timedelta = None, workers: int = None):
+        self.timeout = timeout or Vault.timeout
+        self.workers = workers
+        self.vaults = {}
+        # name -> idle deadline (monotonic), and (deadline, name) heap entries of at most one per vault
+        self._deadlines = {}
+        self._heap = []
+        self._queued = set()
+        self._cond = threading.Condition()
+        self._timer = None
+        self._closed = False
+
+    def unlock(self, passwords: dict, **kwargs) -> dict:
+        '''
+            Unlock vaults given as name -> password, returns name -> unlocked
+
+            Vaults are opened with `kwargs`, e.g. `cache=True`. Wrong passwords leave a vault out
+        '''
+        vaults = {name: Vault(name, **kwargs) for name in passwords}
+        derivations = {}
+        for name, vault in vaults.items():
+            _, params, salt, _ = encryption.read_header(vault.cfg)
+            derivations[name] = (passwords[name].encode(), salt, params['kdf'])
+
+        workers = min(self.workers or os.cpu_count() or 1, len(vaults))
+        if workers < 2:
+            keys = {name: kdf.derive(*args) for name, args in derivations.items()}
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {name: pool.submit(kdf.derive, *args) for name, args in derivations.items()}
+                keys = {name: future.result() for name, future in futures.items()}
+
+        unlocked = {}
+        for name, vault in vaults.items():
+            unlocked[name] = vault.unlock_key(base64.urlsafe_b64encode(keys[name]))
+            if unlocked[name]:
+                self.add(vault)
+        return unlocked
+
+    def add(self, vault: Vault):
+        '''Manage an already unlocked vault, e.g. one unlocked with a key from the key agent'''
+        if not vault.isunlocked():
+            raise LockedError()
+        # The vault's own check agrees with the deadline kept here
+        vault.timeout = self.timeout
+        with self._cond:
+            if self._closed:
+                raise LockedError("Session is closed")
+            previous = self.vaults.get(vault.name)
+            if previous is not None and previous is not vault:
+                self._expire(vault.name)
+            self.vaults[vault.name] = vault
+            self._touch(vault)
+            if self._timer is None:
+                self._timer = threading.Thread(target=self._run, name='fernetvault-autolock', daemon=True)
+                self._timer.start()
+            self._cond.notify()
+
+    def get(self, name: str) -> Vault:
+        '''The unlocked vault `name`, using it restarts its idle time'''
+        with self._cond:
+            vault = self.vaults.get(name)
+            if vault is None or not vault.isunlocked():
+                raise LockedError("{} is locked".format(name))
+            self._touch(vault)
+            return vault
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.vaults
+
+    def names(self) -> list:
+        return sorted(self.vaults)
+
+    def lock(self, name: str):
+        with self._cond:
+            self._expire(name)
+
+    def lock_all(self):
+        with self._cond:
+            for name in list(self.vaults):
+                self._expire(name)
+
+    def close(self):
+        '''Lock every vault and stop the timer thread'''
+        with self._cond:
+            self._closed = True
+            for name in list(self.vaults):
+                self._expire(name)
+            self._cond.notify()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _touch(self, vault: Vault):
+        vault.touch()
+        deadline = time.monotonic() + self.timeout.total_seconds()
+        self._deadlines[vault.name] = deadline
+        # A queued entry is pushed back with the new deadline once it comes up
+        if vault.name not in self._queued:
+            self._queued.add(vault.name)
+            heapq.heappush(self._heap, (deadline, vault.name))
+
+    def _expire(self, name: str):
+        vault = self.vaults.pop(name, None)
+        self._deadlines.pop(name, None)
+        if vault is None:
+            return
+        crypto = getattr(vault, 'crypto', None)
+        vault.lock()
+        if crypto is not None:
+            crypto.wipe()
+
+    def _run(self):
+        with self._cond:
+            while not self._closed:
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    _, name = heapq.heappop(self._heap)
+                    self._queued.discard(name)
+                    deadline = self._deadlines.get(name)
+                    if deadline is None:
+                        # Locked already
+                        continue
+                    if deadline > now:
+                        self._queued.add(name)
+                        # Used since, wait for its new deadline
+                        heapq.heappush(self._heap, (deadline, name))
+                    else:
+                        self._expire(name)
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
@@ -0,0 +1,508 @@
+import contextlib
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+
+from ..utils import atomic_open, atomic_write, fsync_path, sync, lazy_import
+
+# Only sharded vaults hash names
+hashlib = lazy_import('hashlib')
+
+
+class Storage:
+    '''
+        Where a vault keeps its encrypted secret tokens
+
+        Backends only ever see ciphertext, encryption stays in `Vault`
+    '''
+    format = None
+
+    # A `GroupCommit` while a bulk operation defers its fsyncs, see `Vault.group_commit`
+    group = None
+    # The vault's `VaultLocks`, when other processes may share the storage
+    locks = None
+
+    def read(self, name: str) -> bytes:
+        raise NotImplementedError
+
+    def write(self, name: str, token: bytes):
+        raise NotImplementedError
+
+    def delete(self, name: str) -> bool:
+        raise NotImplementedError
+
+    def exists(self, name: str) -> bool:
+        raise NotImplementedError
+
+    def list(self) -> list:
+        raise NotImplementedError
+
+    def mtimes(self) -> dict:
+        '''Secret name -> last modification stamp'''
+        raise NotImplementedError
+
+    def mtime(self, name: str) -> float:
+        raise NotImplementedError
+
+    def sizes(self) -> dict:
+        '''Secret name -> bytes of its token'''
+        raise NotImplementedError
+
+    def token_size(self, name: str) -> int:
+        raise NotImplementedError
+
+    def strays(self) -> list:
+        '''Paths of leftover files that belong to no secret, such as temporary files of interrupted writes'''
+        return []
+
+    def close(self):
+        pass
+
+    def destroy(self):
+        '''Remove every file owned by the backend'''
+        raise NotImplementedError
+
+
+class DirectoryStorage(Storage):
+    '''
+        One file per secret under `<vault>/secrets/`
+
+        The `flat` layout keeps every file directly in the directory. The `sharded` layout, recorded by
+        a `.layout` marker, spreads them over 256 subdirectories named after a hash of the secret name,
+        so no directory grows past a few thousand entries
+    '''
+    format = 'directory'
+    FLAT = 'flat'
+    SHARDED = 'sharded'
+    layouts = (FLAT, SHARDED)
+    marker_name = '.layout'
+
+    # Hex digits of the name hash used as subdirectory
+    fanout = 2
+    # Appended to subdirectory names, secret names never contain dots so no secret file can clash with one
+    shard_suffix = '.d'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.layout = self.FLAT
+        try:
+            with open(os.path.join(path, self.marker_name), 'r') as f:
+                self.layout = f.read().strip() or self.FLAT
+        except OSError:
+            pass
+        if self.layout not in self.layouts:
+            raise ValueError("Unknown directory layout {}".format(self.layout))
+
+    @classmethod
+    def shard(cls, name: str) -> str:
+        return hashlib.sha256(name.encode()).hexdigest()[:cls.fanout] + cls.shard_suffix
+
+    @classmethod
+    def isshard(cls, name: str) -> bool:
+        return name.endswith(cls.shard_suffix) and len(name) == cls.fanout + len(cls.shard_suffix)
+
+    def file(self, name: str) -> str:
+        if self.layout == self.SHARDED:
+            return os.path.join(self.path, self.shard(name), name)
+        return os.path.join(self.path, name)
+
+    def read(self, name: str) -> bytes:
+        with open(self.file(name), 'rb') as f:
+            return f.read()
+
+    def write(self, name: str, token: bytes):
+        path = self.file(name)
+        try:
+            atomic_write(path, token, self.group)
+        except FileNotFoundError:
+            if self.layout != self.SHARDED:
+                raise
+            # First secret of its shard
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            sync(self.path, self.group)
+            atomic_write(path, token, self.group)
+
+    def delete(self, name: str) -> bool:
+        path = self.file(name)
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        sync(os.path.dirname(path), self.group)
+        return True
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self.file(name))
+
+    def _entries(self):
+        '''Directory entries of every secret file, file types come from the directory listing, nothing is stat'ed'''
+        # Secret names never start with a dot, those are markers and temporary files of interrupted writes
+        with os.scandir(self.path) as entries:
+            entries = [e for e in entries if not e.name.startswith('.')]
+        if self.layout == self.FLAT:
+            return [e for e in entries if e.is_file()]
+        found = []
+        for shard in entries:
+            if self.isshard(shard.name) and shard.is_dir():
+                with os.scandir(shard.path) as files:
+                    found.extend(e for e in files if not e.name.startswith('.') and e.is_file())
+        return found
+
+    def list(self) -> list:
+        return [e.name for e in self._entries()]
+
+    def mtimes(self) -> dict:
+        return {e.name: e.stat().st_mtime for e in self._entries()}
+
+    def mtime(self, name: str) -> float:
+        return os.stat(self.file(name)).st_mtime
+
+    def sizes(self) -> dict:
+        return {e.name: e.stat().st_size for e in self._entries()}
+
+    def token_size(self, name: str) -> int:
+        return os.path.getsize(self.file(name))
+
+    def strays(self) -> list:
+        found = []
+        directories = [self.path]
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name == self.marker_name:
+                    continue
+                if entry.name.startswith('.'):
+                    found.append(entry.path)
+                elif self.layout == self.SHARDED and self.isshard(entry.name) and entry.is_dir():
+                    directories.append(entry.path)
+                elif self.layout == self.SHARDED or entry.is_dir():
+                    # Secret files of the other layout, left by an interrupted migration
+                    found.append(entry.path)
+        for directory in directories[1:]:
+            with os.scandir(directory) as entries:
+                found.extend(e.path for e in entries if e.name.startswith('.') or not e.is_file())
+        return found
+
+    def relayout(self, layout: str) -> int:
+        '''
+            Move secret files in place into `layout`, returns how many were moved
+
+            Files are renamed within the directory, never copied, and the marker is updated once all of
+            them moved. Files found anywhere in the directory are picked up, so an interrupted run can
+            simply be repeated. Nothing is moved when two files would end up at the same place
+        '''
+        if layout not in self.layouts:
+            raise ValueError("Unknown directory layout {}".format(layout))
+        # name -> current path, of secret files directly in the directory or in any subdirectory
+        found = {}
+        directories = []
+
+        def add(entries):
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                if entry.name in found:
+                    raise FileExistsError("{} is both {} and {}".format(entry.name, found[entry.name], entry.path))
+                found[entry.name] = entry.path
+
+        with os.scandir(self.path) as entries:
+            entries = [e for e in entries if not e.name.startswith('.')]
+        add(entries)
+        for entry in entries:
+            if entry.is_dir():
+                directories.append(entry.path)
+                with os.scandir(entry.path) as files:
+                    add(list(files))
+
+        def target(name: str) -> str:
+            if layout == self.SHARDED:
+                return os.path.join(self.path, self.shard(name), name)
+            return os.path.join(self.path, name)
+
+        moves = [(path, target(name)) for name, path in found.items() if path != target(name)]
+        for path, dst in moves:
+            # Checked before anything moves, a rename would silently replace a file and a directory stands in the way
+            if os.path.lexists(dst):
+                raise FileExistsError("Cannot move {} to {}, it already exists".format(path, dst))
+
+        touched = set()
+        for path, dst in moves:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.rename(path, dst)
+            touched.add(os.path.dirname(path))
+            touched.add(os.path.dirname(dst))
+        for path in touched:
+            fsync_path(path)
+        for path in directories:
+            # Emptied, or left empty by removed secrets
+            if not os.listdir(path) and not (layout == self.SHARDED and self.isshard(os.path.basename(path))):
+                os.rmdir(path)
+        fsync_path(self.path)
+
+        marker = os.path.join(self.path, self.marker_name)
+        if layout == self.SHARDED:
+            atomic_write(marker, (layout + '\n').encode())
+        elif os.path.exists(marker):
+            os.remove(marker)
+            fsync_path(self.path)
+        self.layout = layout
+        return len(moves)
+
+    def destroy(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class PackedStorage(Storage):
+    '''
+        Append-only pack of Fernet tokens plus an offset table
+
+        The pack is a sequence of `+name<TAB>stamp<TAB>token\\n` (store) and `-name\\n` (remove) records.
+        Secret names and tokens never contain tabs or newlines, so the pack can always be replayed.
+        The offset table is a checkpoint of the replayed pack, records appended after the checkpoint
+        are replayed when the storage is opened.
+
+        Reads go through a memory map of the pack. Space taken by overwritten and removed secrets
+        is reclaimed by `compact`, either explicitly or once dead bytes pass `compact_ratio` of the pack.
+
+        Processes sharing the pack take turns appending under the pack lock, and pick up records
+        appended, or a compaction made, by others before every access.
+    '''
+    format = 'packed'
+    pack_name = 'secrets.pack'
+    table_name = 'secrets.offsets'
+
+    def __init__(self, path: str, compact_ratio: float = 0.5, compact_min: int = 1 << 20, checkpoint_every: int = 1000):
+        self.path = path
+        self.pack = os.path.join(path, self.pack_name)
+        self.table = os.path.join(path, self.table_name)
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.checkpoint_every = checkpoint_every
+        self._lock = threading.RLock()
+        self._map = None
+        self._load()
+
+    @classmethod
+    def detect(cls, path: str) -> bool:
+        return os.path.exists(os.path.join(path, cls.pack_name))
+
+    # Offset table
+    def _load(self, repair: bool = False):
+        # name -> [record start, token offset, token length, stamp]
+        self.offsets = {}
+        self.dead = 0
+        self.size = 0
+        self._pending = 0
+        covered = 0
+        if os.path.exists(self.table):
+            with open(self.table, 'r') as f:
+                table = json.load(f)
+            self.offsets = table['offsets']
+            self.dead = table['dead']
+            covered = table['size']
+        if not os.path.exists(self.pack):
+            open(self.pack, 'ab').close()
+        self._ino = os.stat(self.pack).st_ino
+        if covered > os.path.getsize(self.pack):
+            # Checkpoint belongs to another pack, replay from scratch
+            self.offsets, self.dead, covered = {}, 0, 0
+        self._replay(covered, repair)
+
+    def _replay(self, start: int, repair: bool = False):
+        with open(self.pack, 'rb') as f:
+            f.seek(start)
+            pos = start
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Torn tail from an interrupted append, or one still being written by another process
+                    break
+                self._apply(line, pos)
+                pos += len(line)
+                self._pending += 1
+        if repair and pos < os.path.getsize(self.pack):
+            with open(self.pack, 'r+b') as f:
+                f.truncate(pos)
+                os.fsync(f.fileno())
+        self.size = pos
+
+    def _apply(self, line: bytes, pos: int):
+        if line.startswith(b'+'):
+            name, stamp, token = line[1:-1].split(b'\t', 2)
+            name = name.decode()
+            self._discard(name)
+            offset = pos + len(line) - len(token) - 1
+            self.offsets[name] = [pos, offset, len(token), float(stamp)]
+        elif line.startswith(b'-'):
+            self._discard(line[1:-1].decode())
+            self.dead += len(line)
+
+    def _discard(self, name: str):
+        old = self.offsets.pop(name, None)
+        if old is not None:
+            self.dead += old[1] + old[2] + 1 - old[0]
+
+    def refresh(self, repair: bool = False):
+        '''
+            Pick up records appended, or a compaction made, by other processes
+
+            `repair` truncates a torn tail, only safe while holding the pack lock
+        '''
+        try:
+            st = os.stat(self.pack)
+        except FileNotFoundError:
+            return
+        if st.st_ino != self._ino:
+            self._unmap()
+            self._load(repair)
+        elif st.st_size > self.size or (repair and st.st_size != self.size):
+            self._replay(self.size, repair)
+
+    def _current(self):
+        if self.locks is not None:
+            self.refresh()
+
+    @contextlib.contextmanager
+    def _writing(self):
+        with self._lock, (self.locks.pack() if self.locks is not None else contextlib.nullcontext()):
+            self.refresh(repair=True)
+            yield
+
+    def checkpoint(self):
+        '''Persist the offset table so the next open only replays newer records'''
+        with self._lock:
+            # The pack must be durable up to `size` before a checkpoint claims it
+            if self.group is not None and self.pack in self.group.paths:
+                self.group.paths.discard(self.pack)
+                fsync_path(self.pack)
+            table = {'size': self.size, 'dead': self.dead, 'offsets': self.offsets}
+            atomic_write(self.table, json.dumps(table, separators=(',', ':')).encode(), self.group)
+            self._pending = 0
+
+    # Reads
+    def _mapped(self) -> mmap.mmap:
+        if self._map is None or len(self._map) < self.size:
+            self._unmap()
+            with open(self.pack, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def read(self, name: str) -> bytes:
+        with self._lock:
+            self._current()
+            _, offset, length, _ = self.offsets[name]
+            return self._mapped()[offset:offset + length]
+
+    def exists(self, name: str) -> bool:
+        with self._lock:
+            self._current()
+            return name in self.offsets
+
+    def list(self) -> list:
+        with self._lock:
+            self._current()
+            return list(self.offsets)
+
+    def mtimes(self) -> dict:
+        with self._lock:
+            self._current()
+            return {name: entry[3] for name, entry in self.offsets.items()}
+
+    def mtime(self, name: str) -> float:
+        with self._lock:
+            self._current()
+            return self.offsets[name][3]
+
+    def sizes(self) -> dict:
+        with self._lock:
+            self._current()
+            return {name: entry[2] for name, entry in self.offsets.items()}
+
+    def token_size(self, name: str) -> int:
+        with self._lock:
+            self._current()
+            return self.offsets[name][2]
+
+    # Writes
+    def _append(self, record: bytes) -> int:
+        with open(self.pack, 'ab') as f:
+            f.write(record)
+            if self.group is None:
+                f.flush()
+                os.fsync(f.fileno())
+        if self.group is not None:
+            self.group.add(self.pack)
+        pos = self.size
+        self.size += len(record)
+        self._pending += 1
+        return pos
+
+    def write(self, name: str, token: bytes):
+        with self._writing():
+            record = b'+%s\t%r\t%s\n' % (name.encode(), time.time(), bytes(token))
+            pos = self._append(record)
+            self._apply(record, pos)
+            self._maintain()
+
+    def delete(self, name: str) -> bool:
+        with self._writing():
+            if name not in self.offsets:
+                return False
+            record = b'-%s\n' % name.encode()
+            pos = self._append(record)
+            self._apply(record, pos)
+            self._maintain()
+            return True
+
+    def _maintain(self):
+        if self.dead >= self.compact_min and self.dead >= self.size * self.compact_ratio:
+            self.compact()
+        elif self._pending >= self.checkpoint_every:
+            self.checkpoint()
+
+    def compact(self):
+        '''Rewrite the pack with live records only'''
+        with self._writing():
+            offsets = {}
+            pos = 0
+            src = self._mapped() if self.size else b''
+            with atomic_open(self.pack, self.group) as f:
+                for name, (start, offset, length, stamp) in sorted(self.offsets.items(), key=lambda i: i[1][0]):
+                    record = src[start:offset + length + 1]
+                    f.write(record)
+                    offsets[name] = [pos, pos + offset - start, length, stamp]
+                    pos += len(record)
+                self._unmap()
+            self.offsets, self.size, self.dead = offsets, pos, 0
+            self._ino = os.stat(self.pack).st_ino
+            self.checkpoint()
+
+    def strays(self) -> list:
+        prefix = '.{}.'.format(self.pack_name), '.{}.'.format(self.table_name)
+        with os.scandir(self.path) as entries:
+            return [e.path for e in entries if e.name.startswith(prefix) and e.name.endswith('.tmp')]
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def close(self):
+        with self._lock:
+            if self._pending:
+                with self._writing():
+                    self.checkpoint()
+            self._unmap()
+
+    def destroy(self):
+        self.close()
+        for path in (self.pack, self.table):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+formats = {
+    DirectoryStorage.format: DirectoryStorage,
+    PackedStorage.format: PackedStorage,
+}
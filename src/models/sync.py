@@ -0,0 +1,174 @@
+'''
+    Incremental one-way copy of a vault directory
+
+    Only ciphertext moves, nothing is decrypted. The target keeps manifests of what it holds, under
+    `.fernetvault-sync/`: one of the modification stamp of every directory, and one per directory of
+    the modification stamp, size, inode, SHA-256 and SHA-256 of the last bytes of each file copied into it,
+    so repeated syncs only copy new, changed and deleted files.
+
+    Secret files and attachments are only ever written by renaming a new file into place, which
+    updates their directory's modification stamp. Directories whose stamp is unchanged since the
+    last sync are skipped without reading their manifest, listing or stat'ing their files.
+'''
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from ..utils import atomic_write, GroupCommit
+
+# Manifests, kept out of the mirrored directories so the copy is a vault like any other
+manifest_dir = '.fernetvault-sync'
+# Directory stamps
+dirs_name = 'dirs.json'
+
+# A directory changed within this many seconds of its scan may change again within the same clock tick
+# without a new stamp, such directories are scanned again on the next sync
+racy = 2.0
+
+# Files only ever appended to, or replaced by rename, so a larger file with the same inode only needs its tail
+appended = ('secrets.pack',)
+# Bytes at the end of a file whose SHA-256 is kept, the tail is only copied when they did not change
+edge = 4096
+
+
+def skipped(name: str) -> bool:
+    '''Temporary files, migration staging and sockets are never copied'''
+    if name == '.layout':
+        return False
+    return name.startswith('.') or name.endswith('.tmp') or name.endswith('.migrate') or name.endswith('.sock')
+
+
+def load(path: str) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save(path: str, content: dict, group: GroupCommit = None):
+    atomic_write(path, json.dumps(content, separators=(',', ':')).encode(), group)
+
+
+def files_manifest(target: str, rel: str) -> str:
+    '''Manifest of the files of directory `rel`'''
+    # Vault directory names never contain dots
+    name = 'files.{}.json'.format(rel.replace(os.sep, '.')) if rel else 'files.json'
+    return os.path.join(target, manifest_dir, name)
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def mirror(source: str, target: str) -> dict:
+    '''
+        Bring directory `target` in line with vault directory `source`
+
+        Returns counts of `copied`, `appended`, `deleted` and `unchanged` files, and the `seconds` taken
+    '''
+    start = time.time()
+    # relative path -> [modification stamp or None when it must be scanned again, file count]
+    old_dirs = load(os.path.join(target, manifest_dir, dirs_name)).get('dirs', {})
+    dirs = {}
+    stats = {'copied': 0, 'appended': 0, 'deleted': 0, 'unchanged': 0}
+    group = GroupCommit()
+    os.makedirs(os.path.join(target, manifest_dir), exist_ok=True)
+
+    subdirs = {}
+    for rel in old_dirs:
+        if rel:
+            subdirs.setdefault(os.path.dirname(rel), []).append(rel)
+
+    def copy(rel: str, st: os.stat_result, old: list) -> list:
+        src, dst = os.path.join(source, rel), os.path.join(target, rel)
+        if (old and len(old) > 4 and os.path.basename(rel) in appended and old[2] == st.st_ino
+                and st.st_size > old[1] and os.path.exists(dst) and os.path.getsize(dst) == old[1]):
+            with open(src, 'rb') as f:
+                f.seek(max(0, old[1] - edge))
+                before = f.read(old[1] - f.tell())
+                tail = f.read(st.st_size - old[1])
+            # A file truncated and grown again in place, e.g. compacted, no longer ends the same way
+            if digest(before) == old[4] and len(tail) == st.st_size - old[1]:
+                with open(dst, 'ab') as f:
+                    f.write(tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.utime(dst, ns=(st.st_mtime_ns, st.st_mtime_ns))
+                stats['appended'] += 1
+                return [st.st_mtime_ns, st.st_size, st.st_ino, None, digest((before + tail)[-edge:])]
+
+        with open(src, 'rb') as f:
+            data = f.read()
+        sha = digest(data)
+        if old and old[3] == sha and os.path.exists(dst):
+            # Touched, not changed
+            stats['unchanged'] += 1
+        else:
+            atomic_write(dst, data, group)
+            stats['copied'] += 1
+        os.utime(dst, ns=(st.st_mtime_ns, st.st_mtime_ns))
+        return [st.st_mtime_ns, len(data), st.st_ino, sha, digest(data[-edge:])]
+
+    def walk(rel: str):
+        st = os.stat(os.path.join(source, rel))
+        old = old_dirs.get(rel)
+        if rel and old and old[0] == st.st_mtime_ns:
+            # Nothing was renamed in or out since the last sync
+            dirs[rel] = old
+            stats['unchanged'] += old[1]
+            for sub in subdirs.get(rel, []):
+                if os.path.isdir(os.path.join(source, sub)):
+                    walk(sub)
+            return
+
+        destination = os.path.join(target, rel)
+        os.makedirs(destination, exist_ok=True)
+        manifest = files_manifest(target, rel)
+        old_files = load(manifest)
+        files = {}
+        with os.scandir(os.path.join(source, rel)) as entries:
+            entries = [e for e in entries if not skipped(e.name)]
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                walk(os.path.join(rel, entry.name))
+            elif entry.is_file(follow_symlinks=False):
+                st_file = entry.stat()
+                previous = old_files.get(entry.name)
+                # Files of the vault directory itself may be appended to in place, always compare them
+                if (previous and previous[0] == st_file.st_mtime_ns and previous[1] == st_file.st_size
+                        and previous[2] == st_file.st_ino):
+                    files[entry.name] = previous
+                    stats['unchanged'] += 1
+                else:
+                    files[entry.name] = copy(os.path.join(rel, entry.name), st_file, previous)
+
+        for name in old_files.keys() - files.keys():
+            try:
+                os.remove(os.path.join(destination, name))
+                group.add(destination)
+            except FileNotFoundError:
+                pass
+            stats['deleted'] += 1
+        if files != old_files:
+            save(manifest, files, group)
+        dirs[rel] = [st.st_mtime_ns if st.st_mtime_ns / 1e9 < start - racy else None, len(files)]
+
+    walk('')
+
+    for rel in sorted(old_dirs.keys() - dirs.keys(), reverse=True):
+        stats['deleted'] += old_dirs[rel][1]
+        shutil.rmtree(os.path.join(target, rel), ignore_errors=True)
+        group.add(os.path.dirname(os.path.join(target, rel)))
+        if os.path.exists(files_manifest(target, rel)):
+            os.remove(files_manifest(target, rel))
+
+    group.paths = {path for path in group.paths if os.path.isdir(path)}
+    group.commit()
+    if dirs != old_dirs:
+        # Last, once everything it lists is in place
+        save(os.path.join(target, manifest_dir, dirs_name), {'dirs': dirs})
+    stats['seconds'] = time.time() - start
+    return stats
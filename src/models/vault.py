@@ -1,13 +1,30 @@
 
+import collections
+import contextlib
+import functools
+import itertools
 import os
 import shutil
 
 from datetime import datetime, timedelta
 from .secret import Secret
-from .constants import default_dir
+from .constants import default_dir, default_vault_dir
+from .cache import SecretCache
+from .catalog import Catalog
+from .history import History
+from .index import Index
+from .locking import VaultLocks
+from .search import SearchIndex
+from .storage import DirectoryStorage, PackedStorage, formats
 
-from ..crypto import encryption
-from ..utils import sanitize_name, isvalid_name
+from .. import profiling
+from ..utils import sanitize_name, isvalid_name, lazy_import, atomic_open, atomic_write, fsync_path, GroupCommit
+
+# Only loaded once a vault is unlocked, listing never needs them
+encryption = lazy_import('..crypto.encryption', __package__)
+parallel = lazy_import('..crypto.parallel', __package__)
+stream = lazy_import('..crypto.stream', __package__)
+sync = lazy_import('.sync', __package__)
 
 class LockedError(Exception):
     def __init__(self, message: str='Vault is locked'):
@@ -17,52 +34,317 @@ class SecretNotFoundError(Exception):
     def __init__(self, message: str='Could not find secret'):
         super().__init__(message)
 
+def structural(method):
+    '''Vault operations moving or removing many files, run holding the vault lock exclusively'''
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.locks.vault(exclusive=True):
+            return method(self, *args, **kwargs)
+    return locked
+
 class Vault:
-    
+    # Idle time after which an unlocked vault locks itself
+    timeout = timedelta(minutes=10)
+
+    # Secret payloads above this many bytes are compressed before encryption, see `Secret.dump`
+    compression = 'zlib'
+    compress_above = 1024
+
+    # Earlier versions kept per secret, and for how long, see `history`
+    history_keep = 10
+    history_max_age = timedelta(days=365)
+
     def __init__(self, name: str, **kwargs):
         self.name = sanitize_name(name)
         self.dir = kwargs.get('dir', default_dir(name))
         # :TODO Improve configurability
         self.cfg = os.path.join(self.dir, "{}.cfg".format(self.name))
         self.secrets = os.path.join(self.dir, "secrets/")
+        self.attachments = os.path.join(self.dir, "attachments")
+        self.versions = os.path.join(self.dir, "history")
+        self.index = Index(os.path.join(self.dir, "{}.idx".format(self.name)))
+        # Progress of an interrupted key rotation
+        self.rotation_checkpoint = os.path.join(self.dir, ".rotation")
+        self.search_index = SearchIndex(os.path.join(self.dir, "{}.fts".format(self.name)))
+        self._storage = None
+        # Shared with other processes using the vault, see `locking`
+        self.locks = VaultLocks(self.dir)
+        # Optional cache of decrypted secrets, `cache=True` for default bounds or a `SecretCache`
+        cache = kwargs.get('cache')
+        self.cache = SecretCache() if cache is True else cache or None
+        # Vaults under ~/.vaults keep their entry of the vault catalog up to date
+        home = os.path.dirname(os.path.normpath(self.dir)) == os.path.normpath(default_vault_dir)
+        self.catalog = Catalog() if home else None
+        self._batching = False
         self._islocked = True
+
+    @property
+    def storage(self):
+        '''Storage backend, packed vaults are detected by their pack file'''
+        if self._storage is None:
+            if PackedStorage.detect(self.dir):
+                self._storage = PackedStorage(self.dir)
+            else:
+                self._storage = DirectoryStorage(self.secrets)
+            self._storage.locks = self.locks
+        return self._storage
         
-    def initialize(self, crypto: encryption.Encryption):
+    def initialize(self, crypto: 'encryption.Encryption'):
         if not os.path.exists(self.dir):
             os.mkdir(self.dir)
         if not os.path.exists(self.cfg):
             crypto.write(self.cfg)
+            if self.catalog is not None:
+                self.catalog.set(self.name)
         if not os.path.exists(self.secrets):
             os.mkdir(self.secrets)
     
     def lock(self):
         self._islocked = True
-        del self.crypto
+        self.crypto = None
+        self.index = Index(self.index.path)
+        self.search_index = SearchIndex(self.search_index.path)
+        if self.cache is not None:
+            self.cache.clear()
+        if self._storage is not None:
+            self._storage.close()
 
     def unlock(self, mkey: str) -> bool:
-        with open(self.cfg, 'rb') as f:
-            salt = f.read(16)
-            ekey = f.read()
+        with profiling.phase('vault.unlock'):
+            version, params, salt, ekey = encryption.read_header(self.cfg)
             try:
-                crypto = encryption.Encryption(mkey, salt)
-                crypto.decrypt(ekey)
-                self.crypto = crypto
+                return self._unlock(encryption.Encryption(mkey, salt, kdf=params['kdf']), version, ekey, params)
             except Exception:
                 return False
-        
-            self._opened = datetime.now()
-            self._islocked = False
-            return True
+
+    def unlock_key(self, key: bytes) -> bool:
+        '''Unlock with an already derived key, as handed out by the key agent'''
+        with profiling.phase('vault.unlock'):
+            version, params, salt, ekey = encryption.read_header(self.cfg)
+            return self._unlock(encryption.Encryption.from_key(key, salt, kdf=params['kdf']), version, ekey, params)
+
+    def _unlock(self, crypto: 'encryption.Encryption', version: int, ekey: bytes, params: dict) -> bool:
+        try:
+            header = self._header_stamp()
+            crypto.unwrap(ekey, params.get('keys', []))
+            crypto.legacy = version == 0
+            self.crypto = crypto
+            self._header = header
+        except Exception:
+            return False
+
+        self._opened = datetime.now()
+        self._islocked = False
+        return True
+
+    def _header_stamp(self):
+        st = os.stat(self.cfg)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _refresh_keys(self) -> bool:
+        '''
+            Pick up a key rotation started, or finished, by another process since the vault was unlocked
+
+            Returns True if the keys changed
+        '''
+        try:
+            stamp = self._header_stamp()
+            if stamp == self._header:
+                return False
+            version, params, salt, ekey = encryption.read_header(self.cfg)
+            crypto = encryption.Encryption.from_key(self.crypto.key, salt, kdf=params['kdf'])
+            crypto.unwrap(ekey, params.get('keys', []))
+            crypto.legacy = version == 0
+        except Exception:
+            # Unwrapped with another password, the data keys in use stay valid
+            return False
+        self.crypto, self._header = crypto, stamp
+        return True
+
+    @structural
+    def change_password(self, mkey: str, kdf: dict = None) -> bool:
+        '''
+            Re-wrap the data key under a new master password, and optionally new KDF parameters
+
+            Only the vault header is rewritten, secrets are left untouched
+        '''
+        if not self.isunlocked():
+            raise LockedError()
+        if self.crypto.legacy:
+            raise ValueError("{} must be upgraded before changing its password".format(self.name))
+
+        self._refresh_keys()
+        crypto = encryption.Encryption(mkey, rkey=self.crypto.rkey, kdf=kdf or self.crypto.kdf)
+        crypto.ring = self.crypto.ring
+        crypto.write(self.cfg)
+        self.crypto = crypto
+        self._header = self._header_stamp()
+        return True
+
+    @structural
+    def upgrade(self, workers: int = None, progress=None) -> bool:
+        '''
+            One-time migration of a legacy vault to encrypt its secrets with the data key
+
+            Secrets are re-encrypted across a pool of worker processes, `progress(done, total)` is called
+            as batches complete. The header is only rewritten once every secret uses the data key,
+            an interrupted migration can simply be run again
+        '''
+        if not self.isunlocked():
+            raise LockedError()
+        if not self.crypto.legacy:
+            return False
+
+        self._load_index()
+        self._load_search()
+        names = self.storage.list()
+        rotated = parallel.rotate(self.crypto.rotation_keys(), (self.storage.read(n) for n in names), workers=workers)
+        with self.group_commit():
+            for done, (name, token) in enumerate(zip(names, rotated), 1):
+                self.storage.write(name, token)
+                if progress:
+                    progress(done, len(names))
+
+        rotator = self.crypto.rotator()
+        if os.path.isdir(self.attachments):
+            # Attachment keys were wrapped with the derived key, segments are unaffected
+            for name in os.listdir(self.attachments):
+                if not name.startswith('.') and not name.endswith('.tmp'):
+                    stream.rewrap(self.attachment_file(name), rotator.rotate)
+        if os.path.isdir(self.versions):
+            # So were the versions kept meanwhile
+            for name in os.listdir(self.versions):
+                if not name.startswith('.') and not name.endswith('.tmp'):
+                    self._history(name).rewrap(rotator.rotate)
+
+        self.crypto.legacy = False
+        self.crypto.write(self.cfg)
+        self._header = self._header_stamp()
+        self.index.save(self.crypto)
+        self.search_index.save(self.crypto)
+        return True
+
+    def rotate_keys(self, batch_size: int = 1000, workers: int = None, progress=None) -> dict:
+        '''
+            Re-encrypt every secret with a new data key, while the vault stays readable and writable
+
+            The new key encrypts from the start, the current one stays in the header's key ring until
+            nothing uses it anymore. Secrets are re-encrypted in batches of `batch_size` across a pool
+            of worker processes, each batch recorded in a checkpoint, so an interrupted rotation resumes
+            where it stopped when run again. `progress(done, total)` is called after every batch.
+            Returns the number of secrets `rotated`, out of `total`, and the `seconds` taken
+        '''
+        import json
+        import time
+
+        if not self.isunlocked():
+            raise LockedError()
+        if self.crypto.legacy:
+            raise ValueError("{} must be upgraded before rotating its keys".format(self.name))
+
+        start = time.perf_counter()
+        with self.locks.rotation():
+            # No write can be in flight while the header changes, every later one uses the new key
+            with self.locks.vault(exclusive=True):
+                self._refresh_keys()
+                state = None
+                if self.crypto.ring:
+                    try:
+                        with open(self.rotation_checkpoint, 'r') as f:
+                            state = json.load(f)
+                    except (OSError, ValueError):
+                        pass
+                else:
+                    self.crypto.rotate()
+                    self.crypto.write(self.cfg)
+                    self._header = self._header_stamp()
+                if state is None:
+                    state = {'after': None}
+                    atomic_write(self.rotation_checkpoint, json.dumps(state).encode())
+
+            with self.locks.vault():
+                self._load_index()
+                self._load_search()
+                names = sorted(self.storage.list())
+                total = len(names)
+                if state['after'] is not None:
+                    names = [name for name in names if name > state['after']]
+                done = total - len(names)
+                rotated = 0
+                pending = collections.deque()
+
+                def tokens():
+                    for name in names:
+                        try:
+                            with self.locks.secret(name):
+                                token = self.storage.read(name)
+                        except (OSError, KeyError):
+                            # Removed meanwhile
+                            continue
+                        pending.append((name, token))
+                        yield token
+
+                rotator = self.crypto.rotator()
+                fresh = parallel.rotate(self.crypto.rotation_keys(), tokens(), workers=workers)
+                while True:
+                    batch = list(itertools.islice(fresh, batch_size))
+                    if not batch:
+                        break
+                    with self.group_commit():
+                        for token in batch:
+                            name, old = pending.popleft()
+                            with self.locks.secret(name, exclusive=True):
+                                # Secrets written since they were read already use the new key
+                                if self.storage.exists(name) and self.storage.read(name) == old:
+                                    if self.cache is not None:
+                                        self.cache.invalidate(name)
+                                    self.storage.write(name, token)
+                                    mtime = self.storage.mtime(name)
+                                    self.index.touch(name, mtime)
+                                    self.search_index.touch(name, mtime)
+                                    rotated += 1
+                                # Attachments and versions are re-encrypted even when the secret was written
+                                # since, re-encrypting what already uses the new key changes nothing
+                                if os.path.exists(self.attachment_file(name)):
+                                    stream.rewrap(self.attachment_file(name), rotator.rotate, self.storage.group)
+                                self._history(name).rewrap(rotator.rotate, self.storage.group)
+                            state['after'] = name
+                    atomic_write(self.rotation_checkpoint, json.dumps(state).encode())
+                    done += len(batch)
+                    if progress:
+                        progress(done, total)
+
+            with self.locks.vault(exclusive=True), self.locks.index(exclusive=True):
+                # Indexes hold entries written with either key
+                self.index.load(self.crypto)
+                self.index.save(self.crypto)
+                self.search_index.load(self.crypto)
+                self.search_index.save(self.crypto)
+                self.crypto.retire()
+                self.crypto.write(self.cfg)
+                self._header = self._header_stamp()
+                os.remove(self.rotation_checkpoint)
+
+        return {'rotated': rotated, 'total': total, 'seconds': time.perf_counter() - start}
 
     def isunlocked(self) -> bool:
         if not self._islocked:
-            if self._opened + timedelta(minutes=10) > datetime.now():
+            if self._opened + self.timeout > datetime.now():
                 return True
         
         self.lock()
         return False
 
+    def touch(self):
+        '''Restart the idle time after which the vault locks itself'''
+        if not self._islocked:
+            self._opened = datetime.now()
+
     def store(self, secret: Secret) -> bool:
+        '''Store `secret`, replacing the secret of the same name and its attachment'''
+        return self._store(secret)
+
+    def _store(self, secret: Secret, attachment: bool = False) -> bool:
         if not self.isunlocked():
             raise LockedError()
 
@@ -70,10 +352,171 @@ class Vault:
         if not isvalid_name(secret.name):
             return False
         
-        with open(self.secret_file(secret.name), 'wb') as f:
-                f.write(self.crypto.encrypt(str(secret)))
-                f.close()
+        # The index is updated before other processes can write the same secret
+        with profiling.phase('vault.store'), self.locks.vault(), self.locks.secret(secret.name, exclusive=True):
+            mtime = self._write(secret, attachment)
+
+            # Appended as a delta, the index is not read back
+            self.index.add(secret, mtime)
+            self.search_index.add(secret, mtime)
+            self._flush_index()
+        self._flush_catalog()
         return True
+
+    def _write(self, secret: Secret, attachment: bool = False) -> float:
+        '''Encrypt and write `secret`, its attachment is removed unless `attachment`, the write of `store_file`'''
+        if self.cache is not None:
+            self.cache.invalidate(secret.name)
+        with profiling.phase('secret.dump'):
+            payload = secret.dump(self.compression, self.compress_above)
+        with self.locks.vault(), self.locks.secret(secret.name, exclusive=True):
+            # Encrypted under the lock, with the new key of a rotation started by another process
+            self._refresh_keys()
+            if self.history_keep:
+                self._remember(secret.name, payload)
+            token = self.crypto.encrypt(payload)
+            old = self._token_size(secret.name) if self.catalog is not None else None
+            with profiling.phase('io.write'):
+                self.storage.write(secret.name, token)
+                mtime = self.storage.mtime(secret.name)
+                if not attachment and os.path.exists(self.attachment_file(secret.name)):
+                    # Replaced along with the secret it belonged to
+                    os.remove(self.attachment_file(secret.name))
+            if self.catalog is not None:
+                self.catalog.change(self.name, 1 if old is None else 0, len(token) - (old or 0))
+            return mtime
+
+    def _token_size(self, name: str):
+        try:
+            return self.storage.token_size(name)
+        except (OSError, KeyError):
+            return None
+
+    def _flush_catalog(self):
+        if self.catalog is not None and not self._batching:
+            self.catalog.flush()
+
+    def _read(self, name: str):
+        with profiling.phase('vault.read'), self.locks.vault(), self.locks.secret(name):
+            if not self.storage.exists(name):
+                return None
+            if self.cache is None:
+                return self._decrypt(name)[0]
+
+            try:
+                mtime = self.storage.mtime(name)
+            except (OSError, KeyError):
+                return None
+            secret = self.cache.get(name, mtime)
+            if secret is None:
+                secret, size = self._decrypt(name)
+                self.cache.put(name, secret, mtime, size)
+            return secret
+
+    def _remember(self, name: str, payload: bytes):
+        '''
+            Keep the version of secret `name` about to be replaced by `payload` in its history
+
+            History never stands in the way of a write: a new secret, or a damaged one being
+            overwritten, has no version to keep, and a damaged history is started over
+        '''
+        try:
+            token = self.storage.read(name)
+        except (OSError, KeyError):
+            # New secret
+            return
+        history = self._history(name)
+        try:
+            older = Secret.plain(self.crypto.decrypt(token))
+        except Exception:
+            # Versions are rebuilt from the one being replaced, without it they are lost
+            history.delete()
+            return
+        newer = Secret.plain(payload)
+        if older == newer:
+            return
+        max_age = self.history_max_age.total_seconds() if self.history_max_age else None
+        with profiling.phase('history.append'):
+            try:
+                history.append(self.crypto, older, newer, self.history_keep, max_age, self.storage.group)
+            except Exception:
+                try:
+                    history.delete()
+                    history.append(self.crypto, older, newer, self.history_keep, max_age, self.storage.group)
+                except Exception:
+                    pass
+
+    def _decrypt(self, name: str) -> tuple:
+        '''Returns the secret `name` and the size of its plaintext'''
+        with profiling.phase('io.read'):
+            token = self.storage.read(name)
+        try:
+            plaintext = self.crypto.decrypt(token)
+        except Exception:
+            # Encrypted with a key from a rotation this process has not seen yet
+            if not self._refresh_keys():
+                raise
+            plaintext = self.crypto.decrypt(token)
+        with profiling.phase('secret.load'):
+            return Secret.load(plaintext), len(plaintext)
+
+    def store_many(self, secrets, workers: int = None) -> list:
+        '''
+            Store many secrets after a single unlock, returns stored, as `store` would, for each secret in order
+
+            Encryption and writes run on a thread pool, with a bounded number of secrets in flight,
+            and the index is flushed once at the end. Secrets of the same name are written one after
+            another, in order, so the last one wins
+        '''
+        if not self.isunlocked():
+            raise LockedError()
+
+        secrets = list(secrets)
+        stored = [isvalid_name(secret.name) for secret in secrets]
+
+        with self.group_commit():
+            valid = (secret for secret, ok in zip(secrets, stored) if ok)
+            for secret, mtime in pipelined(self._write, valid, workers, key=lambda secret: secret.name):
+                self.index.add(secret, mtime)
+                self.search_index.add(secret, mtime)
+        return stored
+
+    @contextlib.contextmanager
+    def group_commit(self):
+        '''
+            Batch the fsyncs of writes made inside the block, and flush the index once when it ends
+
+            Each secret is still written to a temporary file and renamed into place, only the directory
+            (or pack) fsyncs making those renames durable are deferred. A crash inside the block may lose
+            some of its writes, it never leaves one half written
+        '''
+        if self._batching:
+            yield
+            return
+        storage = self.storage
+        storage.group = GroupCommit()
+        self._batching = True
+        try:
+            yield
+        finally:
+            self._batching = False
+            try:
+                if (self.index.changes or self.search_index.changes) and self.crypto is not None:
+                    self._flush_index()
+            finally:
+                group, storage.group = storage.group, None
+                group.commit()
+                self._flush_catalog()
+
+    def read_many(self, names, workers: int = None):
+        '''
+            Yield (name, Secret) for each of `names`, in order, Secret is None for names not in the vault
+
+            Reads and decryption run on a thread pool, with a bounded number of secrets in flight
+        '''
+        if not self.isunlocked():
+            raise LockedError()
+        return pipelined(self._read, names, workers)
     
     def read(self, secret: str) -> Secret:
         if not self.isunlocked():
@@ -83,9 +526,7 @@ class Vault:
             raise SecretNotFoundError()
         
         '''Decrypt and return a secret, given its `name`'''
-        with open(self.secret_file(secret), 'rb') as f:
-                d = self.crypto.decrypt(f.read())
-                return Secret.load(d)
+        return self._read(secret)
     
     def remove(self, secret: str) -> bool:
         '''Remove a secret from the filesytem'''
@@ -93,38 +534,402 @@ class Vault:
             return False
         if not self.has_secret(secret):
             return False
+        if self.cache is not None:
+            self.cache.invalidate(secret)
+        with self.locks.vault(), self.locks.secret(secret, exclusive=True):
+            size = self._token_size(secret) if self.catalog is not None else None
+            if not self.storage.delete(secret):
+                return False
+            if size is not None:
+                self.catalog.change(self.name, -1, -size)
+            if os.path.exists(self.attachment_file(secret)):
+                os.remove(self.attachment_file(secret))
+            self._history(secret).delete()
+
+            self.index.discard(secret)
+            self.search_index.discard(secret)
+            self._flush_index()
+        self._flush_catalog()
+        return True
+    
+    # Versions
+    def _history(self, name: str) -> History:
+        return History(os.path.join(self.versions, name))
+
+    def history(self, name: str) -> list:
+        '''
+            (version, replaced at, Secret) of the earlier versions of secret `name`, newest first
+
+            Versions are numbered from 1, the oldest ever stored, the current version is not listed
+        '''
+        if not self.isunlocked():
+            raise LockedError()
+        if not self.has_secret(name):
+            raise SecretNotFoundError()
+        with self.locks.vault(), self.locks.secret(name):
+            current = Secret.plain(self._payload(name))
+            return [(version, stamp, Secret.load(payload))
+                    for version, stamp, payload in self._history(name).versions(self.crypto, current)]
+
+    def restore(self, name: str, version: int) -> bool:
+        '''
+            Store `version` of secret `name` as its current version, which is kept in its history
+
+            Attachments are not versioned, the secret keeps its current attachment, if any
+        '''
+        if not self.isunlocked():
+            raise LockedError()
+        for number, _, secret in self.history(name):
+            if number == version:
+                secret.name = name
+                return self._store(secret, attachment=True)
+        raise SecretNotFoundError("{} has no version {}".format(name, version))
+
+    def prune_history(self, keep: int = None, max_age: timedelta = None) -> int:
+        '''Drop versions beyond `keep` per secret or older than `max_age`, the vault's defaults unless given'''
+        if not self.isunlocked():
+            raise LockedError()
+        keep = self.history_keep if keep is None else keep
+        max_age = max_age or self.history_max_age
+        pruned = 0
+        if not os.path.isdir(self.versions):
+            return pruned
+        with self.locks.vault(), self.group_commit():
+            for name in os.listdir(self.versions):
+                if name.startswith('.'):
+                    continue
+                with self.locks.secret(name, exclusive=True):
+                    if self._history(name).prune(self.crypto, keep, max_age.total_seconds() if max_age else None,
+                                                 self.storage.group):
+                        pruned += 1
+        return pruned
+
+    def _payload(self, name: str) -> bytes:
         try:
-            os.remove(self.secret_file(secret))
-            return True
-        except OSError:
+            return self.crypto.decrypt(self.storage.read(name))
+        except Exception:
+            if not self._refresh_keys():
+                raise
+            return self.crypto.decrypt(self.storage.read(name))
+
+    # Attachments
+    def attachment_file(self, name: str) -> str:
+        return os.path.join(self.attachments, name)
+
+    def store_file(self, name: str, src, **fields) -> bool:
+        '''
+            Store the contents of binary stream `src` as an encrypted attachment of secret `name`
+
+            The stream is encrypted in fixed size segments, memory use does not grow with its size
+        '''
+        if not self.isunlocked():
+            raise LockedError()
+        if not isvalid_name(name):
             return False
-    
+
+        os.makedirs(self.attachments, exist_ok=True)
+        path = self.attachment_file(name)
+        with self.locks.vault(), self.locks.secret(name, exclusive=True):
+            self._refresh_keys()
+            with profiling.phase('attachment.encrypt'), atomic_open(path, self.storage.group) as dst:
+                size = stream.encrypt(self.crypto, src, dst)
+
+            attachment = {'size': size}
+            if getattr(src, 'name', None) and isinstance(src.name, str):
+                attachment['filename'] = os.path.basename(src.name)
+            return self._store(Secret(name, attachment=attachment, **fields), attachment=True)
+
+    def has_attachment(self, name: str) -> bool:
+        return os.path.exists(self.attachment_file(name))
+
+    def export_attachment(self, name: str, dst) -> int:
+        '''Decrypt the attachment of secret `name` into binary stream `dst`, returns its size'''
+        if not self.isunlocked():
+            raise LockedError()
+        if not self.has_attachment(name):
+            raise SecretNotFoundError("{} has no attachment".format(name))
+        self._refresh_keys()
+        with self.locks.vault(), self.locks.secret(name), profiling.phase('attachment.decrypt'), \
+                open(self.attachment_file(name), 'rb') as src:
+            return stream.decrypt(self.crypto, src, dst)
+
     def secret_file(self, name: str) -> str:
         '''Obtain a secret's file location'''
+        if isinstance(self.storage, DirectoryStorage):
+            return self.storage.file(name)
         return os.path.join(self.secrets, name)
     
     def has_secret(self, name: str) -> bool:
-        return os.path.exists(self.secret_file(name))
+        return self.storage.exists(name)
     
     # Vaul collections
+    def stats(self) -> dict:
+        '''Number of secrets, bytes of their tokens and last modification time, read without unlocking'''
+        with self.locks.vault():
+            sizes = self.storage.sizes()
+            mtimes = self.storage.mtimes()
+        return {'secrets': len(sizes), 'bytes': sum(sizes.values()),
+                'mtime': max(mtimes.values()) if mtimes else os.path.getmtime(self.cfg)}
+
     def list(self):
-        '''List secrets associated with the vault by listing the vault's secret dir'''
-        return [f for f in os.listdir(self.secrets) if os.path.isfile(os.path.join(self.secrets, f))]
+        '''List secrets associated with the vault'''
+        with profiling.phase('vault.list'):
+            return self.storage.list()
+
+    def query(self, category: str = None, tag: str = None, url_contains: str = None) -> list:
+        '''Filter secrets by metadata, answered from the encrypted index alone'''
+        if not self.isunlocked():
+            raise LockedError()
+
+        with profiling.phase('vault.query'):
+            self._load_index()
+            if self.index.sync(self.storage.mtimes(), self.read):
+                self._flush_index()
+            return self.index.query(category=category, tag=tag, url_contains=url_contains)
+
+    def search(self, text: str, limit: int = None) -> list:
+        '''
+            Names of the secrets containing every word of `text`, best matches first, answered from
+            the encrypted search index alone
+
+            Words also match longer words they start, e.g. `prod` finds `production`
+        '''
+        return [name for name, score in self.search_ranked(text, limit)]
+
+    def search_ranked(self, text: str, limit: int = None) -> list:
+        '''(name, score) of the matches of `search`'''
+        if not self.isunlocked():
+            raise LockedError()
+
+        with profiling.phase('vault.search'):
+            self._load_search()
+            if self.search_index.sync(self.storage.mtimes(), self.read) or self.search_index.deltas >= Index.max_deltas:
+                with self.locks.vault(), self.locks.index(exclusive=True):
+                    self.search_index.save(self.crypto)
+            return self.search_index.search(text, limit)
+
+    def _load_index(self):
+        if not self.index.loaded:
+            with profiling.phase('index.load'), self.locks.vault(), self.locks.index():
+                self._refresh_keys()
+                self.index.load(self.crypto)
+
+    def _load_search(self):
+        if not self.search_index.loaded:
+            with profiling.phase('search.load'), self.locks.vault(), self.locks.index():
+                self._refresh_keys()
+                self.search_index.load(self.crypto)
+
+    def _flush_index(self):
+        '''Bulk operations flush the index once, when they are done'''
+        if not self._batching:
+            with profiling.phase('index.flush'), self.locks.vault(), self.locks.index(exclusive=True):
+                self._refresh_keys()
+                self.index.flush(self.crypto)
+                self.search_index.flush(self.crypto)
     
     def purge(self) -> bool:
         if not self.isunlocked():
             return False
         try:
-            shutil.rmtree(self.secrets)
-            shutil.rmtree(self.dir)
+            with self.locks.vault(exclusive=True):
+                self.storage.destroy()
+                shutil.rmtree(self.dir)
+            self.locks.close()
+            if self.catalog is not None:
+                self.catalog.drop(self.name)
             return True
         except:
             raise
 
+    # Storage formats
+    @structural
+    def migrate_format(self, fmt: str) -> bool:
+        '''
+            Move every secret token, as is, to a different storage backend
+
+            The new backend is fully written before the old one is removed
+        '''
+        if not self.isunlocked():
+            raise LockedError()
+        if fmt not in formats:
+            raise ValueError("Unknown storage format {}".format(fmt))
+        if fmt == self.storage.format:
+            return False
+
+        source = self.storage
+        if fmt == PackedStorage.format:
+            staging = os.path.join(self.dir, ".migrate")
+            os.makedirs(staging, exist_ok=True)
+            target = PackedStorage(staging)
+        else:
+            staging = self.secrets.rstrip('/') + ".migrate"
+            os.makedirs(staging, exist_ok=True)
+            target = DirectoryStorage(staging)
+
+        target.group = GroupCommit()
+        for name in source.list():
+            target.write(name, source.read(name))
+        if isinstance(target, PackedStorage):
+            # Even an empty pack needs its offset table
+            target.checkpoint()
+        target.close()
+        target.group.commit()
+
+        if fmt == PackedStorage.format:
+            for filename in (PackedStorage.table_name, PackedStorage.pack_name):
+                os.replace(os.path.join(staging, filename), os.path.join(self.dir, filename))
+            os.rmdir(staging)
+            fsync_path(self.dir)
+            source.destroy()
+            self._storage = PackedStorage(self.dir)
+            self._storage.locks = self.locks
+        else:
+            os.replace(staging, self.secrets.rstrip('/'))
+            fsync_path(self.dir)
+            source.destroy()
+            self._storage = DirectoryStorage(self.secrets)
+            self._storage.locks = self.locks
+
+        # Metadata is unchanged, only modification stamps moved with the backend
+        self._load_index()
+        mtimes = self.storage.mtimes()
+        for name, entry in self.index.entries.items():
+            if name in mtimes:
+                entry['mtime'] = mtimes[name]
+        self.index.save(self.crypto)
+        self._load_search()
+        for name, entry in self.search_index.entries.items():
+            if name in mtimes:
+                entry['mtime'] = mtimes[name]
+        self.search_index.save(self.crypto)
+        return True
+
+    @structural
+    def migrate_layout(self, layout: str) -> bool:
+        '''
+            Move the secret files of a directory vault, in place, to the `flat` or hashed `sharded` layout
+
+            Returns False when the vault already uses `layout` and no file was left behind by an interrupted run
+        '''
+        if not self.isunlocked():
+            raise LockedError()
+        if not isinstance(self.storage, DirectoryStorage):
+            raise ValueError("{} is not a directory vault".format(self.name))
+        previous = self.storage.layout
+        moved = self.storage.relayout(layout)
+        return moved > 0 or previous != layout
+
+    def sync_to(self, target: str) -> dict:
+        '''
+            Mirror the vault's encrypted files into `<target>/<name>`, copying only what changed since the last sync
+
+            Needs no unlock, nothing is decrypted. Returns the counts of `sync.mirror`
+        '''
+        with self.locks.vault():
+            return sync.mirror(self.dir, os.path.join(target, self.name))
+
+    def verify(self, sample: int = None, workers: int = None, progress=None) -> dict:
+        '''
+            Decrypt and parse every secret, or a random `sample` of them, on a pool of worker processes
+
+            Returns a report of `checked` out of `total` secrets, `problems` (name -> problem),
+            `orphans` (paths of files belonging to no secret) and `seconds` taken
+        '''
+        import random
+        import time
+
+        if not self.isunlocked():
+            raise LockedError()
+        start = time.perf_counter()
+        with self.locks.vault():
+            names = self.storage.list()
+            total = len(names)
+            if sample is not None and sample < total:
+                names = random.sample(names, sample)
+            problems = {}
+            unreadable = []
+
+            def tokens():
+                for name in names:
+                    try:
+                        yield name, self.storage.read(name)
+                    except (OSError, KeyError):
+                        unreadable.append(name)
+                        problems[name] = 'unreadable'
+
+            checked = 0
+            for name, problem in parallel.verify(self.crypto.keys(), tokens(), Secret.load, workers):
+                checked += 1
+                if problem is not None:
+                    problems[name] = problem
+                if progress:
+                    progress(checked + len(unreadable), len(names))
+
+            orphans = self.storage.strays()
+            if os.path.isdir(self.attachments):
+                for name in sorted(os.listdir(self.attachments)):
+                    if name.startswith('.') or name.endswith('.tmp') or not self.storage.exists(name):
+                        orphans.append(self.attachment_file(name))
+            if os.path.isdir(self.versions):
+                for name in sorted(os.listdir(self.versions)):
+                    if name.startswith('.') or name.endswith('.tmp') or not self.storage.exists(name):
+                        orphans.append(self._history(name).path)
+
+        return {
+            'checked': len(names),
+            'total': total,
+            'problems': problems,
+            'orphans': orphans,
+            'seconds': time.perf_counter() - start,
+        }
+
+    @structural
+    def compact(self) -> bool:
+        '''Reclaim space held by removed and overwritten secrets in packed vaults'''
+        if not self.isunlocked():
+            raise LockedError()
+        if not isinstance(self.storage, PackedStorage):
+            return False
+        self.storage.compact()
+        return True
+
     # built-ins
     def __str__(self):
         return '{} @ {}'.format(self.name, str(self.dir))
     
+def pipelined(fn, items, workers: int = None, key=None):
+    '''
+        Yield (item, fn(item)) in order, running `fn` on a thread pool
+
+        At most a few calls per worker are in flight, so `items` can be arbitrarily large. Items with the
+        same `key(item)` are never in flight together, each waits for the calls before it to finish
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        inflight = collections.Counter()
+
+        def oldest():
+            item, future = pending.popleft()
+            if key is not None:
+                inflight[key(item)] -= 1
+            return item, future.result()
+
+        for item in items:
+            if key is not None:
+                k = key(item)
+                while inflight[k] > 0:
+                    yield oldest()
+                inflight[k] += 1
+            pending.append((item, pool.submit(fn, item)))
+            if len(pending) >= workers * 4:
+                yield oldest()
+        while pending:
+            yield oldest()
+
 def unlock(vault: Vault, mkey: str) -> Vault:
     '''
         Unlocks a vault and returns the unlocked vault
@@ -0,0 +1,116 @@
+'''
+    Opt-in timing of named phases
+
+    Code marks phases with `with profiling.phase('crypto.decrypt'): ...`. Until timing is turned on,
+    with `enable()` or by adding a hook, a phase costs a single check. Once on, every phase is
+    timed: `enable()` keeps per phase totals for `report()`, and hooks are called with
+    (phase, seconds) after each one, so services can forward timings to their own metrics:
+
+        profiling.add_hook(lambda phase, seconds: histogram.labels(phase).observe(seconds))
+
+    Phases nest, e.g. `vault.read` includes `io.read`, `crypto.decrypt` and `secret.load`,
+    and their times are reported inclusive of nested phases.
+'''
+import threading
+import time
+
+_enabled = False
+_hooks = []
+# Whether phases are timed at all
+_active = False
+# phase -> [calls, seconds, max seconds]
+_totals = {}
+_lock = threading.Lock()
+
+
+class _Phase:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+
+
+class _Untimed:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_untimed = _Untimed()
+
+
+def phase(name: str):
+    '''Context manager timing the block as phase `name`'''
+    return _Phase(name) if _active else _untimed
+
+
+def record(name: str, seconds: float):
+    if _enabled:
+        with _lock:
+            totals = _totals.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+    for hook in _hooks:
+        hook(name, seconds)
+
+
+def _update():
+    global _active
+    _active = _enabled or bool(_hooks)
+
+
+def enable():
+    global _enabled
+    _enabled = True
+    _update()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    _update()
+
+
+def add_hook(hook):
+    '''Call `hook(phase, seconds)` after every timed phase'''
+    _hooks.append(hook)
+    _update()
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+    _update()
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+def report() -> dict:
+    '''Phase -> calls, seconds, max_seconds and mean_seconds, since enabled or reset'''
+    with _lock:
+        return {
+            name: {'calls': calls, 'seconds': seconds, 'max_seconds': longest, 'mean_seconds': seconds / calls}
+            for name, (calls, seconds, longest) in sorted(_totals.items())
+        }
+
+
+def format_report(phases: dict) -> str:
+    lines = ["{:<24} {:>7} {:>11} {:>11}".format("phase", "calls", "total ms", "mean ms")]
+    for name, stats in phases.items():
+        lines.append("{:<24} {:>7} {:>11.3f} {:>11.3f}".format(
+            name, stats['calls'], stats['seconds'] * 1000, stats['mean_seconds'] * 1000))
+    return "\n".join(lines)
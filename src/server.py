@@ -0,0 +1,256 @@
+'''
+    Local secret-serving daemon
+
+    Unlocks the chosen vaults once and serves secret reads over HTTP, on a Unix socket or on localhost:
+
+        GET /v1/<vault>/secrets          names the client may read
+        GET /v1/<vault>/secrets/<name>   a secret, as JSON
+        GET /metrics                     per endpoint request counters and latencies
+        GET /health
+
+    Clients are identified by their uid on the Unix socket, or by a bearer token over HTTP,
+    and may only read what the ACL file grants them:
+
+        {"clients": [
+            {"uid": 1000, "allow": {"MyVault": ["db-*", "api"]}},
+            {"token": "...", "allow": {"MyVault": ["*"]}}
+        ]}
+'''
+import argparse
+import fnmatch
+import getpass
+import hmac
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+from . import agent
+from .models.cache import SecretCache
+from .models.constants import default_config_dir
+from .models.vault import Vault, LockedError, SecretNotFoundError
+from .utils import isvalid_name
+
+default_socket = os.path.join(default_config_dir, "serve.sock")
+
+
+class ACL:
+    def __init__(self, clients: list):
+        self.clients = clients
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'r') as f:
+            return cls(json.load(f).get('clients', []))
+
+    def client(self, uid: int = None, token: str = None):
+        for client in self.clients:
+            if uid is not None and client.get('uid') == uid:
+                return client
+            if token is not None and 'token' in client and hmac.compare_digest(client['token'].encode(), token.encode()):
+                return client
+        return None
+
+    def uids(self) -> set:
+        '''Uids granted access'''
+        return {client['uid'] for client in self.clients if 'uid' in client}
+
+    @staticmethod
+    def allows(client: dict, vault: str, secret: str) -> bool:
+        if client is None:
+            return False
+        return any(fnmatch.fnmatchcase(secret, pattern) for pattern in client.get('allow', {}).get(vault, []))
+
+
+class Metrics:
+    '''Request counters and latencies, per endpoint'''
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, status: int, elapsed: float):
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, {'requests': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['requests'] += 1
+            stats['errors'] += status >= 400
+            stats['seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            uptime = time.monotonic() - self.started
+            return {
+                'uptime_seconds': uptime,
+                'endpoints': {
+                    endpoint: {
+                        **stats,
+                        'mean_seconds': stats['seconds'] / stats['requests'],
+                        'requests_per_second': stats['requests'] / uptime if uptime else 0.0,
+                    } for endpoint, stats in self.endpoints.items()
+                },
+            }
+
+
+class SecretHandler(BaseHTTPRequestHandler):
+    server_version = 'fernetvault'
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def identify(self):
+        if self.server.address_family == socket.AF_UNIX:
+            creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+            _, uid, _ = struct.unpack('3i', creds)
+            return self.server.acl.client(uid=uid)
+        auth = self.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            return self.server.acl.client(token=auth[len('Bearer '):])
+        return None
+
+    def reply(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        start = time.perf_counter()
+        endpoint, status, body = self.route([unquote(p) for p in self.path.split('?')[0].strip('/').split('/')])
+        self.reply(status, body)
+        self.server.metrics.record(endpoint, status, time.perf_counter() - start)
+
+    def route(self, parts: list) -> tuple:
+        '''Returns (endpoint, status, body)'''
+        if parts == ['health']:
+            return '/health', 200, {'ok': True}
+        if parts == ['metrics']:
+            return '/metrics', 200, self.server.metrics.snapshot()
+        if len(parts) not in (3, 4) or parts[0] != 'v1' or parts[2] != 'secrets':
+            return 'other', 404, {'error': 'Not found'}
+
+        endpoint = '/v1/{vault}/secrets' if len(parts) == 3 else '/v1/{vault}/secrets/{name}'
+        vault = self.server.vaults.get(parts[1])
+        if vault is None:
+            return endpoint, 404, {'error': 'Unknown vault'}
+        if len(parts) == 4 and not isvalid_name(parts[3]):
+            # Checked on the decoded name, before the ACL, `%2F` must never reach another file
+            return endpoint, 400, {'error': 'Invalid secret name'}
+        try:
+            client = self.identify()
+            if len(parts) == 3:
+                if client is None:
+                    return endpoint, 403, {'error': 'Forbidden'}
+                names = [n for n in vault.list() if ACL.allows(client, vault.name, n)]
+                return endpoint, 200, {'secrets': sorted(names)}
+            if not ACL.allows(client, vault.name, parts[3]):
+                return endpoint, 403, {'error': 'Forbidden'}
+            return endpoint, 200, vault.read(parts[3]).to_dict()
+        except SecretNotFoundError:
+            return endpoint, 404, {'error': 'Could not find secret'}
+        except LockedError:
+            return endpoint, 503, {'error': 'Vault is locked'}
+        except Exception as err:
+            if self.server.verbose:
+                self.log_error("%s: %r", endpoint, err)
+            return endpoint, 500, {'error': 'Internal error'}
+
+
+class SecretServer:
+    daemon_threads = True
+    # Many clients connect at once when a node boots
+    request_queue_size = 128
+    verbose = False
+
+    def setup_vaults(self, vaults: list, acl: ACL):
+        self.vaults = {vault.name: vault for vault in vaults}
+        self.acl = acl
+        self.metrics = Metrics()
+
+
+class HTTPSecretServer(SecretServer, ThreadingHTTPServer):
+    pass
+
+
+class UnixSecretServer(SecretServer, socketserver.ThreadingUnixStreamServer):
+    def __init__(self, path: str, handler):
+        self.path = path
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        # Access is decided by the ACL, any local user who can reach the socket's directory may connect
+        umask = os.umask(0o111)
+        try:
+            super().__init__(path, handler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def open_vault(name: str, cache: bool) -> Vault:
+    '''Unlock with the key agent when possible, otherwise prompt for the password'''
+    vault = Vault(name, cache=cache)
+    key = agent.get_key(vault)
+    if not (key and vault.unlock_key(key)) and not vault.unlock(getpass.getpass("Unlock {}: ".format(name))):
+        exit("Could not unlock {}".format(name))
+    return vault
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(prog='fernetvault serve', description="Serve secret reads to local clients")
+    parser.add_argument('vaults', help="Vaults to serve", nargs='+')
+    parser.add_argument('--acl', help="JSON file granting clients access to secrets", required=True)
+    parser.add_argument('--socket', help="Unix socket to listen on (default)", nargs='?', const=default_socket, default=None)
+    parser.add_argument('--http', help="Listen on localhost at this port instead", type=int)
+    parser.add_argument('--cache', help="Cache decrypted secrets in memory", action='store_true')
+    parser.add_argument('--lock-after', dest="lock_after", help="Lock vaults after this many minutes (default never)", type=int)
+    parser.add_argument('--verbose', help="Log every request", action='store_true')
+    args = parser.parse_args(argv)
+
+    acl = ACL.load(args.acl)
+    if not args.http and (args.socket or default_socket) == default_socket and acl.uids() - {os.getuid()}:
+        # The default socket is in a directory only its owner can enter
+        exit("Other users cannot reach {}, serve them on a socket they can reach with --socket PATH".format(default_socket))
+    vaults = []
+    for name in args.vaults:
+        vault = open_vault(name, args.cache and SecretCache())
+        # A daemon keeps its vaults open, unless told otherwise
+        vault.timeout = timedelta(minutes=args.lock_after) if args.lock_after else timedelta(days=36500)
+        vaults.append(vault)
+
+    if args.http:
+        server = HTTPSecretServer(('127.0.0.1', args.http), SecretHandler)
+        where = "http://127.0.0.1:{}".format(args.http)
+    else:
+        server = UnixSecretServer(args.socket or default_socket, SecretHandler)
+        where = server.path
+    server.setup_vaults(vaults, acl)
+    server.verbose = args.verbose
+
+    print("Serving {} @ {}".format(", ".join(v.name for v in vaults), where), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for vault in vaults:
+            vault.lock()
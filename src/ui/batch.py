@@ -0,0 +1,119 @@
+'''
+    Newline delimited JSON batch operations, e.g.
+
+        {"op": "store", "name": "db", "value": "hunter2"}
+        {"op": "store", "name": "web", "secret": {"url": "example.com", "password": "..."}}
+        {"op": "read", "name": "db"}
+        {"op": "remove", "name": "web"}
+
+    Each operation gets one JSON result line, in order. Consecutive operations of the same kind
+    are handed to the vault's bulk APIs together
+'''
+import itertools
+import json
+
+from ..models.secret import Secret
+from ..models.vault import Vault, SecretNotFoundError, pipelined
+from ..utils import isvalid_name
+
+# Operations grouped into a single bulk call
+window = 256
+
+
+def parse(lines):
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            op = json.loads(line)
+            if not isinstance(op, dict) or op.get('op') not in ('store', 'read', 'remove') or not op.get('name'):
+                raise ValueError("Expected an op of store, read or remove and a name")
+            if not isinstance(op['name'], str) or not isvalid_name(op['name']):
+                raise ValueError("Invalid secret name")
+        except ValueError as err:
+            op = {'op': 'invalid', 'name': None, 'error': "line {}: {}".format(number, err)}
+        yield op
+
+
+def to_secret(op: dict) -> Secret:
+    if isinstance(op.get('secret'), dict):
+        fields = op['secret']
+        for field in ('url', 'category', 'notes'):
+            if not isinstance(fields.get(field, ''), str):
+                raise ValueError("{} must be a string".format(field))
+        tags = fields.get('tags', [])
+        if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+            raise ValueError("tags must be a list of strings")
+        return Secret(**{**fields, 'name': op['name']})
+    return Secret(op['name'], value=str(op.get('value', '')))
+
+
+def result(op: dict, ok: bool, **kwargs) -> dict:
+    return {'op': op['op'], 'name': op['name'], 'ok': ok, **kwargs}
+
+
+def message(err: Exception) -> str:
+    # Some errors, such as InvalidToken, carry no message
+    return str(err) or type(err).__name__
+
+
+def execute(vault: Vault, kind: str, ops: list):
+    '''Yield one result per operation of a group of operations of the same `kind`'''
+    if kind == 'store':
+        secrets, errors = [], {}
+        for op in ops:
+            try:
+                secrets.append(to_secret(op))
+            except Exception as err:
+                errors[id(op)] = message(err)
+        # One result per secret, in order, however often a name repeats
+        stored = iter(vault.store_many(secrets))
+        for op in ops:
+            if id(op) in errors:
+                yield result(op, False, error=errors[id(op)])
+            elif next(stored):
+                yield result(op, True)
+            else:
+                yield result(op, False, error="Invalid secret name")
+    elif kind == 'read':
+        def read(name: str):
+            # One unreadable secret fails its own operation only
+            try:
+                return vault.read(name).to_dict(), None
+            except SecretNotFoundError:
+                return None, "Could not find secret"
+            except Exception as err:
+                return None, message(err)
+
+        for op, (_, (secret, error)) in zip(ops, pipelined(read, [op['name'] for op in ops])):
+            yield result(op, False, error=error) if error else result(op, True, secret=secret)
+    elif kind == 'remove':
+        for op in ops:
+            try:
+                ok = vault.remove(op['name'])
+            except Exception as err:
+                yield result(op, False, error=message(err))
+                continue
+            yield result(op, ok) if ok else result(op, False, error="Could not remove secret")
+    else:
+        for op in ops:
+            yield result(op, False, error=op['error'])
+
+
+def run(vault: Vault, lines, out) -> int:
+    '''Apply operations read from `lines`, streaming results to `out`, returns the number of failures'''
+    failures = 0
+    for kind, group in itertools.groupby(parse(lines), key=lambda op: op['op']):
+        while True:
+            ops = list(itertools.islice(group, window))
+            if not ops:
+                break
+            try:
+                results = list(execute(vault, kind, ops))
+            except Exception as err:
+                results = [result(op, False, error=message(err)) for op in ops]
+            for res in results:
+                failures += not res['ok']
+                out.write(json.dumps(res) + '\n')
+            out.flush()
+    return failures
@@ -1,4 +1,5 @@
 import os
+from datetime import datetime
 from ..models import vault
 from ..models.constants import default_vault_dir
 
@@ -9,7 +10,21 @@ def print_as_list(content: list):
 
 
 def list_vaults(base_dir: str = default_vault_dir):
-    return [f for f in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, f)) and not os.path.join(base_dir, f).startswith(".")]
+    return [f for f in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, f)) and not f.startswith(".")]
+
+
+def print_stats(vaults: dict):
+    '''Vaults with their catalog entry, name -> {'secrets', 'bytes', 'mtime'}'''
+    for name, entry in sorted(vaults.items()):
+        size = entry['bytes']
+        for unit in ('B', 'KiB', 'MiB', 'GiB'):
+            if size < 1024 or unit == 'GiB':
+                break
+            size /= 1024
+        print('- [{}] {} secrets, {:.{}f} {}, modified {}'.format(
+            name, entry['secrets'], size, 0 if unit == 'B' else 1, unit,
+            datetime.fromtimestamp(entry['mtime']).strftime('%Y-%m-%d %H:%M')))
+    print("\n")
 
 
 def list_and_select(base_dir: str = default_vault_dir):
@@ -26,12 +41,26 @@ def list_and_select(base_dir: str = default_vault_dir):
     return False
 
 
-def list_vault(which: vault.Vault):
+def list_vault(which: vault.Vault, search: str = None, **filters):
+    '''
+        List all secrets or, given metadata `filters`, only those matching in the vault index
+
+        Given `search` words, only secrets containing them are listed, best matches first
+    '''
+    filters = {k: v for k, v in filters.items() if v is not None}
+    if search:
+        found = which.search(search)
+        if filters:
+            matching = set(which.query(**filters))
+            found = [name for name in found if name in matching]
+        return found
+    if filters:
+        return which.query(**filters)
     return which.list()
 
 
-def list_vault_and_select(vault: vault.Vault):
-    all_secrets = list_vault(vault)
+def list_vault_and_select(vault: vault.Vault, **filters):
+    all_secrets = list_vault(vault, **filters)
     if len(all_secrets) > 0:
         print("\n{} secrets: \n".format(vault.name))
         print_as_list(all_secrets)
@@ -39,6 +68,8 @@ def list_vault_and_select(vault: vault.Vault):
                     
         if chosen in all_secrets:
             return chosen
+    elif any(v is not None for v in filters.values()):
+        exit("** No secrets of {} match".format(vault.name))
     else:
         exit("** {} has no secrets".format(vault.name))
     return False
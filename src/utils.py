@@ -1,3 +1,7 @@
+import contextlib
+import importlib.util
+import os
+import sys
 from argparse import ArgumentParser
 
 
@@ -17,3 +21,87 @@ def isvalid_name(name: str) -> bool:
 
 def exit_with(err: Exception):
     return exit(getattr(err, 'message', str(err)))
+
+
+def lazy_import(name: str, package: str = None):
+    '''
+        Import module `name` (relative to `package`), deferring its execution until an attribute is first used
+
+        Keeps heavy dependencies, such as `cryptography`, out of startup for commands that never need them
+    '''
+    name = importlib.util.resolve_name(name, package)
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def fsync_path(path: str):
+    '''fsync a file or directory by path, a directory fsync makes renames and unlinks inside it durable'''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class GroupCommit:
+    '''
+        Paths whose fsync is deferred until `commit`
+
+        Bulk operations pay one fsync per touched directory (or pack file) instead of one per write
+    '''
+    def __init__(self):
+        self.paths = set()
+
+    def add(self, path: str):
+        self.paths.add(path)
+
+    def commit(self):
+        while self.paths:
+            fsync_path(self.paths.pop())
+
+
+def sync(path: str, group: GroupCommit = None):
+    if group is not None:
+        group.add(path)
+    else:
+        fsync_path(path)
+
+
+@contextlib.contextmanager
+def atomic_open(path: str, group: GroupCommit = None):
+    '''
+        Binary file object whose contents replace `path` atomically, and durably, once the block completes
+
+        Data goes to a temporary file next to `path`, which is fsynced and renamed over it,
+        then the directory is fsynced (or left to `group`). Readers see the old or the new file, never a partial one
+    '''
+    import tempfile
+
+    directory = os.path.dirname(path) or '.'
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.{}.'.format(os.path.basename(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    sync(directory, group)
+
+
+def atomic_write(path: str, data: bytes, group: GroupCommit = None):
+    with atomic_open(path, group) as f:
+        f.write(data)